@@ -1 +0,0 @@
-DEBUG=true python -m streamlit run 1_txt2img.py --server.port 8184 --server.address 0.0.0.0
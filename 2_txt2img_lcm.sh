@@ -1 +0,0 @@
-DEBUG=true python -m streamlit run 2_txt2img_lcm.py --server.port 8088
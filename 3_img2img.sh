@@ -1 +0,0 @@
-DEBUG=true python -m streamlit run 3_img2img.py --server.port 8189 --server.address 0.0.0.0
@@ -1 +0,0 @@
-DEBUG=true python -m streamlit run 4_extra_single_image.py --server.port 8181 --server.address 0.0.0.0
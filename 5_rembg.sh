@@ -1 +0,0 @@
-DEBUG=true python -m streamlit run 5_rembg.py --server.port 8188 --server.address 0.0.0.0
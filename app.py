@@ -0,0 +1,22 @@
+import streamlit as st
+
+from lib import sidebar_links
+
+if __name__ == "__main__":
+    sidebar_links("Extension for Stable Diffusion on AWS")
+
+    st.markdown(
+        """
+        Pick a task in the sidebar:
+
+        - **txt2img**: generate an image from a prompt
+        - **txt2img lcm**: txt2img with the LCM LoRA in 4 steps
+        - **img2img**: generate an image from a prompt and an init image
+        - **extra single image**: upscale an image
+        - **rembg**: remove the background of an image
+
+        All pages share one API client and connection pool per API URL, key, username and
+        inference type. Defaults for the inputs are read from `.env`
+        (`API_URL`, `API_KEY`, `API_USERNAME`).
+        """
+    )
@@ -0,0 +1 @@
+python -m streamlit run app.py --server.port 8501 --server.address 0.0.0.0
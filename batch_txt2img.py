@@ -0,0 +1,176 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import math
+import time
+
+from lib import API_URL, API_KEY, API_USERNAME, AdmissionController, AsyncApi, JobPipeline, PollingStrategy, \
+    ResultCache, StatusScheduler, metrics, txt2img_inference_body, txt2img_api_params
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def read_prompts(path: str):
+    """Yields one row per prompt: a dict for CSV, the raw line for JSONL.
+
+    JSONL rows are objects (or bare strings); CSV needs a `prompt` column and any other
+    column is passed through as an override, JSON-decoded when possible (e.g. seed, steps).
+    Rows are decoded and checked by prompt_overrides() per job, so a bad line fails only its job.
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield {k: v if k == 'prompt' else _csv_value(v) for k, v in row.items() if v != ''}
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def prompt_overrides(row):
+    """txt2img api_params overrides of one read_prompts() row, with a non-empty `prompt`."""
+    if isinstance(row, str):
+        row = json.loads(row)
+        if isinstance(row, str):
+            row = {'prompt': row}
+    if not isinstance(row, dict):
+        raise ValueError(f"expected a JSON object or string, got {row!r}")
+    if not isinstance(row.get('prompt'), str) or not row['prompt']:
+        raise ValueError("row has no prompt")
+    return dict(row)
+
+
+def _csv_value(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def percentile(values, p: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[k]
+
+
+async def run_batch(pipeline: JobPipeline, rows, manifest, concurrency: int = 8, download_dir: str = None):
+    """Runs txt2img jobs for `rows` through `pipeline` with at most `concurrency` in flight,
+    appending one JSON line per finished job to the open `manifest` file. Returns summary stats.
+
+    With `download_dir` the result images are downloaded there as `<index>-<n>.<ext>`
+    before presigned URLs expire."""
+    api = pipeline.api
+    rows = enumerate(rows)
+    latencies = []
+    stats = {'submitted': 0, 'succeed': 0, 'failed': 0}
+    transfer = {'images': 0, 'bytes': 0, 'seconds': 0.0}
+    started = time.monotonic()
+
+    async def worker():
+        for index, row in rows:
+            stats['submitted'] += 1
+            record = {'index': index}
+            t0 = time.monotonic()
+            try:
+                row = prompt_overrides(row)
+                prompt = record['prompt'] = row.pop('prompt')
+                models = row.pop('models', None)
+                body = txt2img_inference_body(api.api_username, api.inference_type, models)
+                data = await pipeline.run(body, txt2img_api_params(prompt, **row))
+                record['status'] = data.get('status', 'succeed')
+                record['inference_id'] = data.get('id') or data.get('InferenceJobId')
+                record['img_presigned_urls'] = data.get('img_presigned_urls', [])
+                if data.get('cached'):
+                    record['cached'] = True
+                if data.get('params_upload'):
+                    record['params_upload'] = data['params_upload']
+                if download_dir and record['status'] == 'succeed':
+                    results = await api.download_results(record['img_presigned_urls'], download_dir, f"{index}-",
+                                                         transfer, body['task_type'])
+                    record['files'] = [r['path'] for r in results]
+            except Exception as e:
+                logger.exception(e)
+                record['status'] = 'failed'
+                record['error'] = str(e)
+            record['latency'] = round(time.monotonic() - t0, 3)
+
+            latencies.append(record['latency'])
+            stats['succeed' if record['status'] == 'succeed' else 'failed'] += 1
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    elapsed = time.monotonic() - started
+    done = stats['succeed'] + stats['failed']
+    stats.update({
+        'elapsed': round(elapsed, 3),
+        'jobs_per_min': round(done / elapsed * 60, 2) if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies, default=0.0),
+        'downloaded_bytes': transfer['bytes'],
+        'download_bytes_per_sec': round(transfer['bytes'] / transfer['seconds'], 1) if transfer['seconds'] else 0.0,
+    })
+    return stats
+
+
+async def main(args):
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    admission = AdmissionController.from_spec(args.api_rates) if args.api_rates else None
+    async with AsyncApi(args.api_url, args.api_key, args.api_username, args.inference_type,
+                        pool_size=max(args.concurrency * 2, 10), params_encoding=args.params_encoding,
+                        admission_controller=admission) as api:
+        polling = PollingStrategy(args.poll_initial, max_interval=args.poll_max)
+        result_cache = ResultCache() if args.result_cache else None
+        async with StatusScheduler(api, polling, args.status_concurrency, args.status_rate) as scheduler, \
+                JobPipeline(api, scheduler, args.create_workers, args.upload_workers, args.start_workers,
+                            result_cache=result_cache) as pipeline:
+            with open(args.output, 'a') as manifest:
+                stats = await run_batch(pipeline, read_prompts(args.input), manifest, args.concurrency, args.download)
+
+    print(f"{stats['succeed'] + stats['failed']} jobs ({stats['succeed']} succeed, {stats['failed']} failed) "
+          f"in {stats['elapsed']}s, {stats['jobs_per_min']} jobs/min")
+    if args.download:
+        print(f"downloaded {stats['downloaded_bytes']} bytes at {stats['download_bytes_per_sec']} bytes/s")
+    print(f"latency p50 {stats['p50']}s p90 {stats['p90']}s p99 {stats['p99']}s max {stats['max']}s")
+    if args.metrics:
+        metrics.write(args.metrics)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run txt2img inference jobs for every prompt in a JSONL/CSV file")
+    parser.add_argument("input", help="prompts file, .jsonl or .csv")
+    parser.add_argument("-o", "--output", default="batch_manifest.jsonl", help="result manifest (JSONL, appended)")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="max jobs in flight")
+    parser.add_argument("--poll-initial", type=float, default=1, help="first status poll interval in seconds")
+    parser.add_argument("--poll-max", type=float, default=10, help="max status poll interval in seconds")
+    parser.add_argument("--create-workers", type=int, default=4, help="concurrent create inference requests")
+    parser.add_argument("--upload-workers", type=int, default=4, help="concurrent api_params uploads")
+    parser.add_argument("--start-workers", type=int, default=4, help="concurrent start inference requests")
+    parser.add_argument("--status-concurrency", type=int, default=10, help="max status requests in flight")
+    parser.add_argument("--status-rate", type=float, default=None, help="max status requests per second")
+    parser.add_argument("--result-cache", action="store_true",
+                        help="reuse results of identical fixed-seed requests instead of running them again")
+    parser.add_argument("--download", metavar="DIR", help="download result images into DIR")
+    parser.add_argument("--metrics", metavar="FILE", help="write OpenMetrics job phase metrics to FILE when done")
+    parser.add_argument("--metrics-port", type=int, help="serve OpenMetrics job phase metrics on this port")
+    parser.add_argument("--params-encoding", choices=('gzip', 'zstd'), help="compress api_params uploads")
+    parser.add_argument("--api-rates", help="create/start/status calls per second, default API_RATES or "
+                                            "create=10,start=10,status=50,task=10; off to disable")
+    parser.add_argument("--inference-type", default="Async", choices=('Async', 'Real-time'))
+    parser.add_argument("--api-url", default=API_URL)
+    parser.add_argument("--api-key", default=API_KEY)
+    parser.add_argument("--api-username", default=API_USERNAME)
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
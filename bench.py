@@ -0,0 +1,208 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# the Api renders payloads with st.* calls; outside `streamlit run` those only log warnings
+os.environ.setdefault('STREAMLIT_LOGGER_LEVEL', 'error')
+
+from batch_txt2img import percentile
+from lib import AdmissionController, Api, PollingStrategy, metrics, templates, task_types, task_inference_body, \
+    txt2img_api_params, txt2img_lcm_template, encode_api_params
+
+logger = logging.getLogger(__name__)
+
+
+def uploader(api: Api, task_type: str, index: int, source_url: str):
+    """The api_params upload each page does for `task_type`, as upload(s3_url)."""
+    prompt = f"a cute cat, benchmark {index}"
+    if task_type == 'extra-single-image':
+        params = templates.get('extra-single-image-api-params.json')
+        return lambda s3_url: api.upload_api_params_with_image(s3_url, params, 'image', source_url)
+    if task_type == 'rembg':
+        params = templates.get('rembg-api-params.json')
+        return lambda s3_url: api.upload_api_params_with_image(s3_url, params, 'input_image', source_url)
+    if task_type == 'img2img':
+        params = templates.render('img2img_api_param.json', prompt=prompt, seed=index)
+    elif task_type == 'txt2img-lcm':
+        params = txt2img_api_params(prompt, txt2img_lcm_template, seed=index)
+    else:
+        params = txt2img_api_params(prompt, seed=index)
+    return lambda s3_url: api.upload_api_params(s3_url, encode_api_params(params))
+
+
+def run_job(api: Api, task_type: str, index: int, source_url: str, polling: PollingStrategy):
+    """One full job lifecycle through the Api; returns (status, seconds, image bytes)."""
+    started = time.monotonic()
+    body = task_inference_body(api.api_username, api.inference_type, task_type)
+    upload = uploader(api, task_type, index, source_url)
+
+    if api.inference_type == 'Real-time':
+        result = api.run_real_time_inference(body, upload=upload)
+        return result['data'].get('status', 'succeed'), time.monotonic() - started, len(result['image'] or b'')
+
+    data = api.run_inference_job(body, upload, polling)
+
+    size = 0
+    for url in data.get('img_presigned_urls', [])[:1]:
+        response = api.request('GET', url)
+        response.raise_for_status()
+        size = len(response.content)
+    return data['status'], time.monotonic() - started, size
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def start_mock_backend(args):
+    """Runs mock_backend.py in its own process so its CPU is not counted as client CPU."""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_backend.py'),
+               '--port', '0', '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--failure-rate', str(args.failure_rate), '--run-seconds', str(args.run_seconds),
+               '--job-failure-rate', str(args.job_failure_rate)]
+    if args.throttle_rate:
+        command += ['--throttle-rate', str(args.throttle_rate)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().split()[4]
+    return process, url
+
+
+def run_benchmark(api: Api, tasks, jobs: int, concurrency: int, source_url: str, polling: PollingStrategy):
+    """Runs `jobs` jobs cycling through `tasks` with `concurrency` in flight; returns a report dict."""
+    results = {task: [] for task in tasks}
+    failures = {task: 0 for task in tasks}
+    downloaded = 0
+
+    def run(item):
+        index, task = item
+        try:
+            return task, run_job(api, task, index, source_url, polling)
+        except Exception as e:
+            logger.warning(f"{task} job {index} failed: {e}")
+            return task, None
+
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for task, result in executor.map(run, zip(range(jobs), itertools.cycle(tasks))):
+            if result is None or result[0] != 'succeed':
+                failures[task] += 1
+                continue
+            results[task].append(result[1])
+            downloaded += result[2]
+    elapsed = time.monotonic() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu_seconds = usage.ru_utime - cpu.ru_utime + usage.ru_stime - cpu.ru_stime
+    latencies = [seconds for task in tasks for seconds in results[task]]
+    report = {
+        'jobs': jobs,
+        'concurrency': concurrency,
+        'inference_type': api.inference_type,
+        'elapsed': round(elapsed, 3),
+        'jobs_per_sec': round(jobs / elapsed, 2),
+        'failed': sum(failures.values()),
+        'admission_rates': api.admission.stats(),
+        'downloaded_bytes': downloaded,
+        'cpu_seconds': round(cpu_seconds, 3),
+        'cpu_ms_per_job': round(cpu_seconds / jobs * 1000, 2),
+        'cpu_percent': round(cpu_seconds / elapsed * 100, 1),
+        'rss_bytes': rss_bytes(),
+        # ru_maxrss is in KiB on Linux
+        'max_rss_bytes': usage.ru_maxrss * 1024,
+        'tasks': {},
+    }
+    for task in tasks + ('all',):
+        values = latencies if task == 'all' else results[task]
+        report['tasks'][task] = {
+            'succeed': len(values),
+            'failed': sum(failures.values()) if task == 'all' else failures[task],
+            'p50': round(percentile(values, 50), 4),
+            'p90': round(percentile(values, 90), 4),
+            'p99': round(percentile(values, 99), 4),
+            'max': round(max(values, default=0.0), 4),
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{report['jobs']} {report['inference_type']} jobs at concurrency {report['concurrency']} "
+          f"in {report['elapsed']}s: {report['jobs_per_sec']} jobs/s, {report['failed']} failed")
+    print(f"client cpu {report['cpu_seconds']}s ({report['cpu_ms_per_job']} ms/job, {report['cpu_percent']}%), "
+          f"rss {report['rss_bytes']} bytes, max rss {report['max_rss_bytes']} bytes")
+    print(f"admission rates {report['admission_rates']}")
+    print(f"{'task':<20}{'succeed':>8}{'failed':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for task, row in report['tasks'].items():
+        print(f"{task:<20}{row['succeed']:>8}{row['failed']:>8}"
+              f"{row['p50']:>10}{row['p90']:>10}{row['p99']:>10}{row['max']:>10}")
+
+
+def main(args):
+    process = None
+    api_url = args.api_url
+    if api_url is None:
+        process, api_url = start_mock_backend(args)
+    source_url = args.source_url or api_url + 'images/cat.png'
+    admission = AdmissionController.from_spec(args.api_rates)
+    try:
+        with Api(api_url, args.api_key, args.api_username, args.inference_type,
+                 pool_size=max(args.concurrency * 2, 10), params_encoding=args.params_encoding,
+                 admission_controller=admission) as api:
+            polling = PollingStrategy(args.poll_initial, max_interval=args.poll_max, jitter=0)
+            # warm up connections and templates so they are not part of the measurement
+            run_benchmark(api, tuple(args.tasks), len(args.tasks), 1, source_url, polling)
+            report = run_benchmark(api, tuple(args.tasks), args.jobs, args.concurrency, source_url, polling)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.metrics:
+        metrics.write(args.metrics)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the client job lifecycle, by default against a "
+                                                 "local mock ESD API")
+    parser.add_argument("-n", "--jobs", type=int, default=100, help="jobs to run")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="jobs in flight")
+    parser.add_argument("--tasks", nargs='+', default=list(task_types), choices=task_types)
+    parser.add_argument("--inference-type", default="Async", choices=('Async', 'Real-time'))
+    parser.add_argument("--params-encoding", choices=('gzip', 'zstd'), help="compress api_params uploads")
+    parser.add_argument("--poll-initial", type=float, default=0.1, help="first status poll interval in seconds")
+    parser.add_argument("--poll-max", type=float, default=1, help="max status poll interval in seconds")
+    parser.add_argument("--latency", type=float, default=0.01, help="mock: seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="mock: random +/- seconds on top of --latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="mock: fraction of API calls failing with 500")
+    parser.add_argument("--run-seconds", type=float, default=0.5, help="mock: time from start to succeed")
+    parser.add_argument("--job-failure-rate", type=float, default=0.0, help="mock: fraction of jobs ending failed")
+    parser.add_argument("--throttle-rate", type=float, help="mock: API calls per second before answering 429")
+    parser.add_argument("--api-rates", default="off",
+                        help="client admission rates, e.g. create=10,status=50,task=10; off (default) so the "
+                             "client, not the limiter, is measured")
+    parser.add_argument("-o", "--output", help="also write the report as JSON, e.g. to compare runs")
+    parser.add_argument("--metrics", metavar="FILE", help="write OpenMetrics job phase metrics to FILE")
+    parser.add_argument("--api-url", help="benchmark a real ESD API instead of the mock")
+    parser.add_argument("--api-key", default='mock')
+    parser.add_argument("--api-username", default='admin')
+    parser.add_argument("--source-url", help="source image for extra-single-image and rembg")
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('lib').setLevel(logging.WARNING)
+    main(parser.parse_args())
@@ -1,17 +1,136 @@
+import abc
+import asyncio
+import base64
+import bisect
+import contextlib
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
 import logging
+import math
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import MappingProxyType
+from urllib.parse import parse_qs, urlparse
 
 import requests
 import streamlit as st
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 default_model = "v1-5-pruned-emaonly.safetensors"
 
+# load .env file with specific name
+load_dotenv(dotenv_path='.env')
+
+# Your ApiGatewayUrl in Extension for Stable Diffusion
+# Example: https://xxxx.execute-api.us-west-2.amazonaws.com/prod/
+API_URL = os.getenv("API_URL")
+# Your ApiGatewayUrlToken in Extension for Stable Diffusion
+API_KEY = os.getenv("API_KEY")
+# Your username in Extension for Stable Diffusion
+# Some resources are limited to specific users
+API_USERNAME = os.getenv("API_USERNAME", 'admin')
+
+# full payload dumps in the UI only when DEBUG is set, size/hash summaries otherwise
+DEBUG = os.getenv("DEBUG", "").lower() in ('1', 'true', 'yes', 'on')
+
+base64_re = re.compile(r'(data:[\w/+.-]+;base64,)?[A-Za-z0-9+/\r\n]+=*')
+
+# orjson when installed, JSON_BACKEND=json forces the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+if os.getenv("JSON_BACKEND", "").lower() == 'json':
+    orjson = None
+
+
+def json_safe(value):
+    """Copy of value with non-finite floats as the strings "Infinity", "-Infinity" and "NaN".
+
+    Plain JSON has no such literals: orjson would write null and the standard library a bare
+    Infinity. The WebUI parses the strings back to floats, so every task type sends those.
+    """
+    if isinstance(value, float):
+        if math.isfinite(value):
+            return value
+        return 'NaN' if math.isnan(value) else ('Infinity' if value > 0 else '-Infinity')
+    if isinstance(value, Mapping):
+        return {k: json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    return value
+
+
+def dumps(value, sort_keys: bool = False) -> bytes:
+    """Compact UTF-8 JSON bytes of value. Separators, key order and strings match across
+    backends; floats may be spelled differently (orjson 0.00001, the standard library 1e-05)."""
+    value = json_safe(value)
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(value, default=str, option=option)
+    return json.dumps(value, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=False,
+                      default=str).encode('utf-8')
+
+
+def loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. bare Infinity/NaN literals, which only the standard library accepts
+            pass
+    return json.loads(data)
+
+
+class LazyJSON(Mapping):
+    """JSON object response body, parsed once on first access; `raw` keeps the bytes."""
+
+    __slots__ = ('raw', '_value')
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = loads(self.raw)
+        return self._value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
 
 class Api:
 
-    def __init__(self, api_url: str, api_key: str, api_username: str, inference_type: str):
+    def __init__(self, api_url: str, api_key: str, api_username: str, inference_type: str,
+                 pool_size: int = 10, timeout=(3.05, 30), retries: int = 3, backoff_factor: float = 0.5,
+                 image_cache=None, params_encoding: str = None, admission_controller=None):
 
         if not api_url or not api_key or not api_username:
             raise Exception("API URL, API KEY and API Username can not be empty")
@@ -20,67 +139,2671 @@ class Api:
         self.api_key = api_key
         self.api_username = api_username
         self.inference_type = inference_type
+        # paces create/start/status calls, the process-wide `admission` unless given
+        self.admission = admission_controller or admission
+        # (connect, read) seconds, applied to every call unless overridden
+        self.timeout = timeout
+        # one keep-alive pool shared by API Gateway calls and presigned S3 PUT/GET; a streamed
+        # upload_api_params_with_image holds two (source GET + params PUT), so size it for
+        # twice the jobs run concurrently
+        self.session = create_session(pool_size, retries, backoff_factor)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        # optional ImageCache for source images (extra-single-image, rembg)
+        self.image_cache = image_cache
+        # optional WarmJobPool of pre-created jobs, see enable_warm_pool
+        self.warm_pool = None
+        # task type and phase clocks per job, for metrics labels
+        self.jobs = JobTracker(inference_type)
+        # optional gzip/zstd Content-Encoding of api_params uploads, dropped if not accepted
+        self.params_encoding = params_encoding
+        # size/time of recent api_params uploads by upload URL, see run_inference_job
+        self.params_uploads = OrderedDict()
 
-    def get_inference_job(self, inference_id: str):
-        headers = {
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.warm_pool is not None:
+            self.warm_pool.close()
+        self.session.close()
+
+    def enable_warm_pool(self, body_factories, size: int = 2, min_ttl: float = 120):
+        """Keep `size` jobs pre-created for each create body produced by body_factories
+        (e.g. one per task type); create_inference_job hands them out for matching bodies."""
+        if self.warm_pool is not None:
+            self.warm_pool.close()
+        self.warm_pool = WarmJobPool(self, body_factories, size, min_ttl)
+        return self.warm_pool
+
+    def headers(self):
+        return {
             "Content-Type": "application/json",
             "Accept": "application/json",
             'x-api-key': self.api_key
         }
 
+    def request(self, method: str, url: str, endpoint: str = None, task_type: str = None, **kwargs):
+        """`endpoint` (create, start or status) routes the call through admission control,
+        429s included: they are retried here, queued behind other callers, not by urllib3."""
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            if endpoint is not None:
+                self.admission.acquire(endpoint, task_type)
+            response = self.session.request(method, url, **kwargs)
+            retries = getattr(response.raw, 'retries', None)
+            if retries is not None and retries.history:
+                metrics.inc('esd_retries', len(retries.history), method=method, inference_type=self.inference_type)
+            if endpoint is None:
+                return response
+            self.admission.record(endpoint, task_type, response.status_code)
+            if response.status_code != 429 or attempt >= self.retries:
+                return response
+            delay = retry_after_seconds(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = self.backoff_factor * (2 ** attempt)
+            attempt += 1
+            metrics.inc('esd_retries', method=method, inference_type=self.inference_type)
+            logger.info(f"{method} {url} throttled, retry {attempt} in {delay}s")
+            time.sleep(delay)
+
+    def get_inference_job(self, inference_id: str):
         url = self.api_url + "inferences/" + inference_id
-        job = requests.get(url, headers=headers)
-        st.info(f"get status of inference job GET {url}")
-        st.json(job.json(), expanded=False)
+        job = LazyJSON(self.request('GET', url, 'status', headers=self.headers()).content)
+        show_payload(f"get status of inference job GET {url}", job)
 
-        return job.json()
+        return job
 
     def start_inference_job(self, inference_id: str):
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            'x-api-key': self.api_key
-        }
-
         url = self.api_url + 'inferences/' + inference_id + '/start'
-        job = requests.put(url, headers=headers)
-        st.info(f"start inference job response PUT {url}")
-        st.json(job.json(), expanded=False)
+        with metrics.time('esd_job_phase_seconds', phase='start', **self.jobs.labels(inference_id)):
+            job = LazyJSON(self.request('PUT', url, 'start', headers=self.headers()).content)
+        self.jobs.started(inference_id)
+        show_payload(f"start inference job response PUT {url}", job)
 
-        return job.json()
+        return job
 
     def create_inference_job(self, body):
-        headers = {
+        if self.warm_pool is not None:
+            job = self.warm_pool.take(body)
+            if job is not None:
+                self.jobs.created(body, job)
+                show_payload("pre-created inference job from warm pool", job)
+                return job
+
+        show_payload("payload for create inference job", body)
+
+        response, job = self.post_inference_job(body)
+        show_payload(f"create inference job response\nPOST {self.api_url}inferences", job)
+
+        if response.status_code == 403:
+            raise Exception(f"Your API URL or API KEY is not correct. Please check your .env file.")
+
+        return job
+
+    def run_real_time_inference(self, body, api_params=None, upload=None, on_status=None):
+        """Fast path for Real-time jobs: create (or take a warm job), upload params and start
+        back to back on the persistent session, then fetch the first image directly.
+
+        `upload(s3_url)` replaces the default params upload when given; on_status(data) is
+        told when the job is created and when it starts running. Returns the start response
+        data, the first image bytes, per-phase timings in seconds and the params upload record.
+        """
+        timings = {}
+        started = phase = time.monotonic()
+
+        def lap(name):
+            nonlocal phase
+            now = time.monotonic()
+            timings[name] = round(now - phase, 3)
+            phase = now
+
+        inference = self._create_job(body)
+        if on_status:
+            on_status({'id': inference['id'], 'status': 'created'})
+        lap('create')
+
+        if upload is not None:
+            upload(inference['api_params_s3_upload_url'])
+        else:
+            self.upload_api_params(inference['api_params_s3_upload_url'], encode_api_params(api_params))
+        params_upload = self.params_uploads.pop(inference['api_params_s3_upload_url'], None)
+        lap('upload')
+
+        labels = self.jobs.labels(inference['id'])
+        # the start request runs the job, so it is the running phase
+        self.jobs.status(inference['id'], 'inprogress')
+        if on_status:
+            on_status({'id': inference['id'], 'status': 'inprogress'})
+        data = self._start_job(inference['id'])['data']
+        self.jobs.status(inference['id'], 'succeed')
+        lap('start')
+
+        image = None
+        if data.get('img_presigned_urls'):
+            with metrics.time('esd_job_phase_seconds', phase='download', **labels):
+                response = self.request('GET', data['img_presigned_urls'][0])
+                response.raise_for_status()
+                image = response.content
+        lap('image')
+
+        timings['total'] = round(time.monotonic() - started, 3)
+        return {'data': data, 'image': image, 'timings': timings, 'params_upload': params_upload}
+
+    def run_inference_job(self, body, upload, polling=None, on_status=None, remaining=None):
+        """Full lifecycle without any UI rendering, so it can run on a background thread.
+
+        `upload(s3_url)` puts the api_params. on_status(data) is called once the job is
+        created and on every status change; remaining() paces the status polls, see
+        wait_for_inference_job. Returns the final job data; Real-time jobs also carry the
+        first image bytes in `images` and their phase `timings`.
+        """
+        if self.inference_type == 'Real-time':
+            result = self.run_real_time_inference(body, upload=upload, on_status=on_status)
+            images = [result['image']] if result['image'] else []
+            return dict(result['data'], status='succeed', images=images, timings=result['timings'],
+                        params_upload=result['params_upload'])
+
+        inference_id, params_upload = self.launch_inference_job(body, upload, on_status)
+        data = self.wait_for_inference_job(inference_id, polling, on_status, remaining)
+        return with_params_upload(self, inference_id, data, params_upload)
+
+    def launch_inference_job(self, body, upload, on_status=None):
+        """Create, upload params and start an Async job; returns (inference id, params upload record)."""
+        inference = self._create_job(body)
+        if on_status:
+            on_status({'id': inference['id'], 'status': 'created'})
+        upload(inference['api_params_s3_upload_url'])
+        params_upload = self.params_uploads.pop(inference['api_params_s3_upload_url'], None)
+        self._start_job(inference['id'])
+        return inference['id'], params_upload
+
+    def _create_job(self, body):
+        job = self.warm_pool.take(body) if self.warm_pool is not None else None
+        if job is not None:
+            self.jobs.created(body, job)
+        else:
+            response, job = self.post_inference_job(body)
+            if response.status_code == 403:
+                raise Exception(f"Your API URL or API KEY is not correct. Please check your .env file.")
+            if not response.ok and job.get('statusCode') != 400:
+                raise Exception(f"create inference job failed with HTTP {response.status_code}: {job.get('message')}")
+        if job['statusCode'] == 400:
+            raise Exception(job['message'])
+        return job['data']['inference']
+
+    def _start_job(self, inference_id: str):
+        with metrics.time('esd_job_phase_seconds', phase='start', **self.jobs.labels(inference_id)):
+            response = self.request('PUT', self.api_url + 'inferences/' + inference_id + '/start', 'start',
+                                    headers=self.headers())
+        run_resp = loads(response.content)
+        if not response.ok and 'errorMessage' not in run_resp:
+            raise Exception(f"start inference job {inference_id} failed with HTTP {response.status_code}: "
+                            f"{run_resp.get('message')}")
+        if 'errorMessage' in run_resp:
+            raise Exception(run_resp['errorMessage'])
+        self.jobs.started(inference_id)
+        return run_resp
+
+    def post_inference_job(self, body):
+        """POST the create request; returns (response, job) with the job body parsed lazily."""
+        labels = {'task_type': body.get('task_type', 'unknown'), 'inference_type': self.inference_type}
+        with metrics.time('esd_job_phase_seconds', phase='create', **labels):
+            response = self.request('POST', self.api_url + "inferences", 'create', labels['task_type'],
+                                    headers=self.headers(), data=dumps(body))
+        job = LazyJSON(response.content)
+        # like AsyncApi, so a `statusCode: 400` body is counted whatever the HTTP status
+        if response.status_code != 403:
+            self.jobs.created(body, job)
+        return response, job
+
+    def delete_inference_jobs(self, inference_ids):
+        if not inference_ids:
+            return
+        response = self.request('DELETE', self.api_url + "inferences", headers=self.headers(),
+                                data=dumps({'inference_id_list': list(inference_ids)}))
+        response.raise_for_status()
+
+    def upload_api_params_with_image(self, s3_url: str, api_params, field: str, img_url: str,
+                                     chunk_size: int = 64 * 1024, preprocess=None):
+        """PUT api_params with `field` set to the base64 of the image at img_url, encoding
+        straight from the download stream so memory stays flat whatever the image size.
+
+        With an image_cache the (revalidated) cached copy and its memoized base64 are used.
+        preprocess(data) -> data (e.g. ImagePreprocessor.process) transforms the image first."""
+        if preprocess is not None:
+            data = preprocess(self.fetch_image(img_url))
+            return self.upload_api_params(s3_url, StreamingParamsBody(api_params, field, [data], len(data)))
+
+        if self.image_cache is not None:
+            entry = self.image_cache.fetch(self, img_url)
+            return self.upload_api_params(s3_url, StreamingParamsBody(
+                api_params, field, self.image_cache.base64_chunks(entry, chunk_size),
+                self.image_cache.base64_size(entry), encoded=True))
+
+        with self.request('GET', img_url, stream=True) as source:
+            if source.status_code != 200:
+                raise Exception(f"get img from {img_url} failed")
+
+            size = source.headers.get('Content-Length')
+            if size is not None and not source.headers.get('Content-Encoding'):
+                return self.upload_api_params(
+                    s3_url, StreamingParamsBody(api_params, field, source.iter_content(chunk_size), int(size)))
+
+            # no reliable length up front: spool to disk (bounded memory) to learn it
+            with tempfile.SpooledTemporaryFile(max_size=16 * chunk_size) as spool:
+                for chunk in source.iter_content(chunk_size):
+                    spool.write(chunk)
+                size = spool.tell()
+                spool.seek(0)
+                chunks = iter(lambda: spool.read(chunk_size), b'')
+                return self.upload_api_params(s3_url, StreamingParamsBody(api_params, field, chunks, size))
+
+    def fetch_image(self, img_url: str):
+        """Source image bytes, through the image_cache when there is one."""
+        if self.image_cache is not None:
+            return self.image_cache.read(self.image_cache.fetch(self, img_url))
+
+        response = self.request('GET', img_url)
+        if response.status_code != 200:
+            raise Exception(f"get img from {img_url} failed")
+        return response.content
+
+    def wait_for_inference_job(self, inference_id: str, polling=None, on_status=None, remaining=None,
+                               max_errors: int = 5):
+        """Polls until the job is succeed or failed and returns its data,
+        calling on_status(data) after every poll. remaining() may estimate the seconds
+        left (or None) to pace the polls. Raises on a 4xx other than 429, or after
+        `max_errors` failed polls in a row."""
+        polling = polling or PollingStrategy()
+        attempt = 0
+        errors = 0
+        while True:
+            data, retry_after = self.poll_inference_job(inference_id, errors, max_errors)
+            errors = 0 if data is not None else errors + 1
+            if data is not None:
+                if on_status:
+                    on_status(data)
+                if data['status'] in ('succeed', 'failed'):
+                    return data
+            time.sleep(polling.interval(attempt, retry_after, remaining() if remaining else None))
+            attempt += 1
+
+    def poll_inference_job(self, inference_id: str, errors: int = 0, max_errors: int = 5):
+        """One status poll after `errors` failed ones in a row: (job data, or None after a
+        retryable HTTP error, Retry-After seconds). Raises as check_poll_status does."""
+        with metrics.time('esd_job_phase_seconds', phase='poll', **self.jobs.labels(inference_id)):
+            response = self.request('GET', self.api_url + "inferences/" + inference_id, 'status',
+                                    headers=self.headers())
+        check_poll_status(inference_id, response.status_code, errors, max_errors)
+        retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+        if not response.ok:
+            return None, retry_after
+        data = loads(response.content)['data']
+        logger.info(f"job {inference_id} status: {data['status']}")
+        self.jobs.status(inference_id, data['status'])
+        return data, retry_after
+
+    def upload_api_params(self, s3_url: str, data):
+        # presigned S3 PUT, reusing the same pooled connections
+        labels = self.jobs.labels(s3_url)
+        encoding = self.params_encoding if isinstance(data, (bytes, str)) else None
+        raw = data.encode('utf-8') if isinstance(data, str) else data
+        started = time.monotonic()
+        with metrics.time('esd_job_phase_seconds', phase='upload', **labels):
+            if encoding:
+                body = compress_params(raw, encoding)
+                response = self.request('PUT', s3_url, data=body, headers={'Content-Encoding': encoding})
+                if response.status_code in encoding_rejected_statuses:
+                    logger.warning(f"{encoding} params upload rejected with HTTP {response.status_code}, "
+                                   f"uploading params uncompressed from now on")
+                    self.params_encoding = encoding = None
+            if not encoding:
+                body = raw
+                response = self.request('PUT', s3_url, data=body)
+        self.jobs.forget(s3_url)
+        response.raise_for_status()
+
+        if isinstance(body, bytes):
+            stats = record_params_upload(len(raw), len(body), encoding, time.monotonic() - started, labels)
+            self.params_uploads[s3_url] = stats
+            while len(self.params_uploads) > 1000:
+                self.params_uploads.popitem(last=False)
+        return response
+
+
+class WarmJobPool:
+    """Inference jobs created ahead of time so an interactive request only has to PUT its
+    params and start.
+
+    Keeps up to `size` jobs per create body (compared without filters.createAt),
+    refilled by a background thread. Jobs whose api_params_s3_upload_url expires within
+    `min_ttl` seconds, and those still pooled at close(), are deleted on the backend
+    instead of handed out.
+    """
+
+    def __init__(self, api: Api, body_factories, size: int = 2, min_ttl: float = 120, retry_interval: float = 10):
+        self.api = api
+        self.size = size
+        self.min_ttl = min_ttl
+        self.retry_interval = retry_interval
+        self._factories = {}
+        for factory in body_factories:
+            self._factories[canonical_inference_body(factory())] = factory
+        self._jobs = {key: deque() for key in self._factories}
+        self._dropped = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._refill, name='warm-job-pool', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        # let the refill thread delete the pooled jobs while the session is still open
+        self._thread.join(timeout=10)
+
+    def available(self, body=None):
+        with self._cond:
+            if body is not None:
+                return len(self._jobs.get(canonical_inference_body(body), ()))
+            return sum(len(jobs) for jobs in self._jobs.values())
+
+    def take(self, body):
+        """A pre-created job response matching body, or None."""
+        key = canonical_inference_body(body)
+        with self._cond:
+            jobs = self._jobs.get(key)
+            if jobs is None:
+                return None
+            self._prune(jobs)
+            job = jobs.popleft()[1] if jobs else None
+            self._cond.notify_all()
+        return job
+
+    def _prune(self, jobs):
+        # dropped jobs are deleted on the backend by the refill thread
+        deadline = time.time() + self.min_ttl
+        while jobs and jobs[0][0] <= deadline:
+            self._dropped.append(jobs.popleft()[1])
+
+    def _delete(self, jobs):
+        inferences = [job['data']['inference'] for job in jobs]
+        for inference in inferences:
+            self.api.jobs.forget(inference['id'])
+            self.api.jobs.forget(inference['api_params_s3_upload_url'])
+        try:
+            self.api.delete_inference_jobs([inference['id'] for inference in inferences])
+        except Exception as e:
+            logger.warning(f"deleting {len(inferences)} expired warm jobs failed: {e}")
+
+    def _next_expiry(self):
+        expiries = [jobs[0][0] for jobs in self._jobs.values() if jobs]
+        return min(expiries) - self.min_ttl - time.time() if expiries else None
+
+    def _refill(self):
+        while True:
+            with self._cond:
+                key = None
+                while key is None and not self._closed and not self._dropped:
+                    for k, jobs in self._jobs.items():
+                        self._prune(jobs)
+                        if len(jobs) < self.size:
+                            key = k
+                            break
+                    else:
+                        if not self._dropped:
+                            self._cond.wait(timeout=self._next_expiry())
+                dropped, self._dropped = self._dropped, []
+                if self._closed:
+                    dropped.extend(job for jobs in self._jobs.values() for _, job in jobs)
+                    for jobs in self._jobs.values():
+                        jobs.clear()
+            if dropped:
+                self._delete(dropped)
+            if self._closed:
+                return
+            if key is None:
+                continue
+
+            try:
+                response, job = self.api.post_inference_job(self._factories[key]())
+                if response.status_code >= 400 or job.get('statusCode') == 400:
+                    raise Exception(job.get('message') or f"HTTP {response.status_code}")
+                expiry = presigned_url_expiry(job['data']['inference']['api_params_s3_upload_url'])
+            except Exception as e:
+                logger.warning(f"warm job pool refill failed: {e}")
+                with self._cond:
+                    self._cond.wait(timeout=self.retry_interval)
+                continue
+
+            with self._cond:
+                self._jobs[key].append((expiry, job))
+
+
+def canonical_inference_body(body):
+    """Stable JSON form of a create body, ignoring the per-request filters.createAt."""
+    body = dict(body)
+    filters = dict(body.get('filters') or {})
+    filters.pop('createAt', None)
+    body['filters'] = filters
+    return json.dumps(body, sort_keys=True, separators=(',', ':'), default=str)
+
+
+class ImageCache:
+    """Local content-addressed cache for fetched source images.
+
+    Blobs are stored on disk by SHA-256; an index maps each URL to its blob and the
+    ETag/Last-Modified used to revalidate it with a conditional GET. Total disk usage is
+    bounded by `max_bytes` with LRU eviction, the base64 encoding of each blob is memoized
+    next to it, and up to `memory_bytes` of raw/base64 blobs are also kept in memory.
+    """
+
+    def __init__(self, directory: str = None, max_bytes: int = 512 * 1024 * 1024, memory_bytes: int = 0):
+        self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'images')
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.RLock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._index_path = os.path.join(self.directory, 'index.json')
+        try:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {'urls': {}, 'blobs': {}}
+
+    def blob_path(self, sha256: str, suffix: str = ''):
+        return os.path.join(self.directory, sha256 + suffix)
+
+    def fetch(self, api, url: str):
+        """Return the cache entry for url, revalidating with ETag/Last-Modified."""
+        with self._lock:
+            entry = self._index['urls'].get(url)
+            if entry and not os.path.exists(self.blob_path(entry['sha256'])):
+                entry = None
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        with api.request('GET', url, headers=headers, stream=True) as response:
+            if entry and response.status_code == 304:
+                self._touch(entry['sha256'])
+                return entry
+            if response.status_code != 200:
+                raise Exception(f"get img from {url} failed")
+
+            digest = hashlib.sha256()
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(64 * 1024):
+                    digest.update(chunk)
+                    f.write(chunk)
+            entry = {
+                'sha256': digest.hexdigest(),
+                'size': os.path.getsize(tmp),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+
+        with self._lock:
+            if os.path.exists(self.blob_path(entry['sha256'])):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, self.blob_path(entry['sha256']))
+            self._index['urls'][url] = entry
+            self._index['blobs'].setdefault(entry['sha256'], {'size': entry['size']})
+            self._touch(entry['sha256'])
+            self._evict()
+        return entry
+
+    def read(self, entry):
+        return self._read(entry['sha256'], '')
+
+    def base64(self, entry):
+        """Memoized base64 of the blob, as ascii bytes."""
+        path = self.blob_path(entry['sha256'], '.b64')
+        if not os.path.exists(path):
+            self._encode(entry)
+        return self._read(entry['sha256'], '.b64')
+
+    def base64_size(self, entry):
+        return 4 * math.ceil(entry['size'] / 3)
+
+    def base64_chunks(self, entry, chunk_size: int = 64 * 1024):
+        if self.memory_bytes >= self.base64_size(entry):
+            return [self.base64(entry)]
+        path = self.blob_path(entry['sha256'], '.b64')
+        if not os.path.exists(path):
+            self._encode(entry)
+        self._touch(entry['sha256'])
+        return self._file_chunks(path, chunk_size)
+
+    @staticmethod
+    def _file_chunks(path: str, chunk_size: int):
+        with open(path, 'rb') as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+
+    def _encode(self, entry):
+        # multiple of 3 so chunk encodings concatenate into one valid base64 string
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with open(self.blob_path(entry['sha256']), 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            for chunk in iter(lambda: src.read(3 * 64 * 1024), b''):
+                dst.write(base64.b64encode(chunk))
+        os.replace(tmp, self.blob_path(entry['sha256'], '.b64'))
+        with self._lock:
+            self._index['blobs'].get(entry['sha256'], {})['b64'] = True
+            self._evict()
+
+    def _read(self, sha256: str, suffix: str):
+        key = sha256 + suffix
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+        if data is None:
+            with open(self.blob_path(sha256, suffix), 'rb') as f:
+                data = f.read()
+            self._remember(key, data)
+        self._touch(sha256)
+        return data
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, old = self._memory.popitem(last=False)
+                self._memory_size -= len(old)
+
+    def _touch(self, sha256: str):
+        with self._lock:
+            blob = self._index['blobs'].get(sha256)
+            if blob is not None:
+                blob['used'] = time.time()
+
+    def _evict(self):
+        blobs = self._index['blobs']
+
+        def disk_size(blob):
+            return blob['size'] + (4 * math.ceil(blob['size'] / 3) if blob.get('b64') else 0)
+
+        total = sum(disk_size(b) for b in blobs.values())
+        for sha256 in sorted(blobs, key=lambda k: blobs[k].get('used', 0)):
+            if total <= self.max_bytes:
+                break
+            total -= disk_size(blobs.pop(sha256))
+            for suffix in ('', '.b64'):
+                self._memory.pop(sha256 + suffix, None)
+                try:
+                    os.remove(self.blob_path(sha256, suffix))
+                except FileNotFoundError:
+                    pass
+            self._index['urls'] = {u: e for u, e in self._index['urls'].items() if e['sha256'] != sha256}
+        self._memory_size = sum(len(v) for v in self._memory.values())
+        self._save()
+
+    def _save(self):
+        tmp = self._index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp, self._index_path)
+
+
+@st.cache_resource
+def shared_image_cache():
+    # one cache (and memory tier) per server process, shared by every session
+    return ImageCache(memory_bytes=64 * 1024 * 1024)
+
+
+@st.cache_resource
+def get_api(api_url: str, api_key: str, api_username: str, inference_type: str):
+    """One Api (and connection pool) per set of credentials, shared by every page and session.
+
+    With WARM_POOL_SIZE set, that many jobs per page are kept pre-created, see WarmJobPool."""
+    api = Api(api_url, api_key, api_username, inference_type, pool_size=2 * job_workers(),
+              image_cache=shared_image_cache(), params_encoding=os.getenv('PARAMS_ENCODING') or None)
+    warm_pool_size = int(os.getenv('WARM_POOL_SIZE', 0))
+    if warm_pool_size > 0:
+        api.enable_warm_pool([functools.partial(task_inference_body, api_username, inference_type, task_type)
+                              for task_type in task_types], warm_pool_size)
+    return api
+
+
+@st.cache_resource
+def shared_preprocessor(image_format: str = 'PNG'):
+    return ImagePreprocessor(image_format)
+
+
+@st.cache_resource
+def shared_blob_store():
+    """BlobStore from BLOB_S3_BUCKET (presigned S3 URLs) or BLOB_URL (plain HTTP), else None."""
+    if os.getenv('BLOB_S3_BUCKET'):
+        return S3BlobStore(os.getenv('BLOB_S3_BUCKET'), os.getenv('BLOB_S3_PREFIX', 'esd-blobs/'))
+    if os.getenv('BLOB_URL'):
+        return HttpBlobStore(os.getenv('BLOB_URL'))
+    return None
+
+
+@st.cache_resource
+def job_runner():
+    # job lifecycles of every session run here, off the Streamlit script threads
+    return JobRunner(job_workers())
+
+
+def job_workers():
+    return int(os.getenv('JOB_WORKERS', 32))
+
+
+class ResultFetcher:
+    """Downloads all result images of a job concurrently over the Api connection pool.
+
+    Each image is streamed to `directory` (or into memory), checked against its
+    Content-Length, and byte/time totals are kept in `stats` for bytes/sec reporting.
+    """
+
+    def __init__(self, api, max_workers: int = 8, chunk_size: int = 256 * 1024):
+        self.api = api
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='result-fetch')
+        self.stats = {'images': 0, 'bytes': 0, 'seconds': 0.0}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    @property
+    def bytes_per_sec(self):
+        return self.stats['bytes'] / self.stats['seconds'] if self.stats['seconds'] else 0.0
+
+    def fetch(self, urls, directory: str = None, prefix: str = '', task_type: str = 'unknown'):
+        """Returns one dict per url, in order: url, bytes, seconds and `path` or `data`.
+        Download times are recorded under the job's `task_type`."""
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        paths = [os.path.join(directory, prefix + result_file_name(url, i)) if directory else None
+                 for i, url in enumerate(urls)]
+        futures = [self.executor.submit(self.fetch_one, url, path, task_type) for url, path in zip(urls, paths)]
+        return [future.result() for future in futures]
+
+    def fetch_one(self, url: str, path: str = None, task_type: str = 'unknown'):
+        started = time.monotonic()
+        with self.api.request('GET', url, stream=True) as response:
+            response.raise_for_status()
+            expected = response.headers.get('Content-Length')
+            out = open(path + '.part', 'wb') if path else io.BytesIO()
+            size = 0
+            try:
+                for chunk in response.iter_content(self.chunk_size):
+                    out.write(chunk)
+                    size += len(chunk)
+                data = None if path else out.getvalue()
+            finally:
+                out.close()
+
+        if expected is not None and not response.headers.get('Content-Encoding') and int(expected) != size:
+            if path:
+                os.remove(path + '.part')
+            raise Exception(f"result image {url} truncated: got {size} of {expected} bytes")
+        if path:
+            os.replace(path + '.part', path)
+
+        seconds = time.monotonic() - started
+        metrics.observe('esd_job_phase_seconds', seconds, phase='download', task_type=task_type,
+                        inference_type=self.api.inference_type)
+        with self._lock:
+            self.stats['images'] += 1
+            self.stats['bytes'] += size
+            self.stats['seconds'] += seconds
+        result = {'url': url, 'bytes': size, 'seconds': seconds}
+        if path:
+            result['path'] = path
+        else:
+            result['data'] = data
+        return result
+
+
+def presigned_url_expiry(url: str, default_ttl: float = 3600):
+    """Epoch seconds at which a SigV4 presigned URL expires (X-Amz-Date + X-Amz-Expires)."""
+    query = parse_qs(urlparse(url).query)
+    try:
+        signed = datetime.strptime(query['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+        return signed.timestamp() + int(query['X-Amz-Expires'][0])
+    except (KeyError, ValueError):
+        return time.time() + default_ttl
+
+
+def result_file_name(url: str, index: int):
+    ext = os.path.splitext(urlparse(url).path)[1] or '.png'
+    return f"{index}{ext}"
+
+
+class ResultCache:
+    """Opt-in memo of finished deterministic jobs (fixed seed, same models and params).
+
+    Keyed by a canonical hash of the create body (minus filters.createAt) and api_params.
+    img_presigned_urls are returned only until they expire; downloaded image bytes are kept
+    on disk so a hit still works after the URLs are gone. Entries older than `ttl` are dropped.
+    """
+
+    def __init__(self, directory: str = None, ttl: float = None, store_images: bool = True):
+        self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'results')
+        self.ttl = ttl
+        self.store_images = store_images
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(body, api_params):
+        """Cache key, or None when the request is not deterministic (random seed/subseed)."""
+        if api_params.get('seed', -1) == -1 and 'seed' in api_params:
+            return None
+        if api_params.get('subseed_strength') and api_params.get('subseed', -1) == -1:
+            return None
+
+        # always the standard library: dumps() output depends on the JSON backend (float formatting)
+        digest = hashlib.sha256(canonical_inference_body(body).encode('utf-8'))
+        digest.update(json.dumps(json_safe(api_params), sort_keys=True, separators=(',', ':'), default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key: str, suffix: str = '.json'):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key: str):
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        now = time.time()
+        if self.ttl is not None and now - entry['stored'] > self.ttl:
+            self.delete(key, entry)
+            return None
+
+        urls = [u for u, expiry in zip(entry['img_presigned_urls'], entry['expires']) if expiry - 60 > now]
+        images = []
+        for i in range(entry['images']):
+            try:
+                with open(self.path(key, f'-{i}.img'), 'rb') as f:
+                    images.append(f.read())
+            except OSError:
+                images = []
+                break
+
+        if not urls and not images:
+            return None
+        return {'status': 'succeed', 'img_presigned_urls': urls, 'images': images, 'cached': True}
+
+    def put(self, key: str, data, api=None, images=None, task_type: str = 'unknown'):
+        """Store a succeed job's data; with an Api (sync) the images are downloaded and kept too."""
+        urls = data.get('img_presigned_urls') or []
+        if images is None and api is not None and self.store_images:
+            with ResultFetcher(api) as fetcher:
+                images = [result['data'] for result in fetcher.fetch(urls, task_type=task_type)]
+        images = images or []
+
+        for i, image in enumerate(images):
+            with open(self.path(key, f'-{i}.img'), 'wb') as f:
+                f.write(image)
+        entry = {
+            'stored': time.time(),
+            'img_presigned_urls': urls,
+            'expires': [presigned_url_expiry(u) for u in urls],
+            'images': len(images),
+        }
+        tmp = self.path(key, '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.path(key))
+
+    def delete(self, key: str, entry=None):
+        for i in range((entry or {}).get('images', 0)):
+            try:
+                os.remove(self.path(key, f'-{i}.img'))
+            except FileNotFoundError:
+                pass
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class BackgroundJob:
+    """One generation submitted to a JobRunner; pages render it from its fields on every rerun.
+
+    Progress follows the backend status (created, then inprogress) and the time spent in
+    it, measured against the typical created/running durations of this task type.
+    """
+
+    # progress share of the created phase; running fills the rest up to `ceiling`
+    created_share = 10
+    ceiling = 95
+
+    def __init__(self, label: str = '', task_type: str = None, inference_type: str = None):
+        self.label = label
+        self.task_type = task_type
+        self.inference_type = inference_type
+        self.status = 'queued'
+        self.since = time.monotonic()
+        self.data = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.future = None
+
+    @property
+    def done(self):
+        return self.status in ('succeed', 'failed')
+
+    def on_status(self, data):
+        if data['status'] != self.status:
+            self.status, self.since = data['status'], time.monotonic()
+
+    def estimate(self, phase: str):
+        return latency_estimates.estimate(phase, self.task_type, self.inference_type)
+
+    def remaining(self):
+        """Estimated seconds until the job finishes, None without history for this task."""
+        running = self.estimate('running')
+        if running is None or self.status not in ('created', 'inprogress'):
+            return None
+        elapsed = time.monotonic() - self.since
+        if self.status == 'inprogress':
+            return max(0.0, running - elapsed)
+        return max(0.0, (self.estimate('created') or 0.0) - elapsed) + running
+
+    @property
+    def progress(self):
+        if self.done:
+            return 100
+        if self.status not in ('created', 'inprogress'):
+            return 0
+        phase, start, share = ('created', 0, self.created_share) if self.status == 'created' else \
+            ('running', self.created_share, self.ceiling - self.created_share)
+        expected = self.estimate(phase)
+        elapsed = time.monotonic() - self.since
+        # without history, creep towards the end of the phase instead of stalling
+        fraction = min(elapsed / expected, 1.0) if expected else 1 - math.exp(-elapsed / 30)
+        return int(start + share * fraction)
+
+    @property
+    def progress_text(self):
+        remaining = self.remaining()
+        if remaining is None:
+            return f"{self.status} for {time.monotonic() - self.since:.0f}s"
+        if remaining <= 0:
+            return f"{self.status}, taking longer than usual"
+        return f"{self.status}, about {math.ceil(remaining)}s left"
+
+    def images(self):
+        """Image bytes when they are at hand (Real-time, cached), presigned URLs otherwise."""
+        data = self.data or {}
+        return data.get('images') or data.get('img_presigned_urls') or []
+
+
+class StatusPoller:
+    """Thread-side StatusScheduler: one thread owns the status polling of every waiting job.
+
+    Jobs sit in a heap keyed by their next poll time and due polls run on at most
+    `max_concurrency` threads, so a waiting job holds no thread of its own. watch() calls
+    done(data, error) once the job is succeed or failed, or its polling failed.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_errors: int = 5):
+        self.max_errors = max_errors
+        self.executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix='poll')
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def watch(self, api: Api, inference_id: str, done, polling=None, on_status=None, remaining=None):
+        polling = polling or PollingStrategy()
+        job = {'api': api, 'id': inference_id, 'done': done, 'polling': polling, 'on_status': on_status,
+               'remaining': remaining, 'attempt': 0, 'errors': 0}
+        self._schedule(job, polling.interval(0, None, remaining() if remaining else None))
+
+    def _schedule(self, job, delay: float):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='status-poller', daemon=True)
+                self._thread.start()
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, job))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._closed:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+            self.executor.submit(self._check, job)
+
+    def _check(self, job):
+        try:
+            data, retry_after = job['api'].poll_inference_job(job['id'], job['errors'], self.max_errors)
+        except Exception as e:
+            job['done'](None, e)
+            return
+
+        job['errors'] = 0 if data is not None else job['errors'] + 1
+        if data is not None:
+            if job['on_status']:
+                try:
+                    job['on_status'](data)
+                except Exception as e:
+                    logger.exception(f"status callback for job {job['id']} failed: {e}")
+            if data['status'] in ('succeed', 'failed'):
+                job['done'](data, None)
+                return
+
+        remaining = job['remaining']() if job['remaining'] else None
+        job['attempt'] += 1
+        self._schedule(job, job['polling'].interval(job['attempt'], retry_after, remaining))
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class JobRunner:
+    """Shared thread pool running job lifecycles, so submitting never blocks a script thread.
+
+    submit() returns a BackgroundJob at once; with a ResultCache and cache_key a stored
+    result is returned as an already finished job, and new results are stored. Once an
+    Async job is started its wait is handed to a StatusPoller, freeing the pool thread.
+    """
+
+    def __init__(self, max_workers: int = 32, poll_concurrency: int = 8):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='job')
+        self.poller = StatusPoller(poll_concurrency)
+
+    def submit(self, api: Api, body, upload, polling=None, label: str = '', result_cache=None, cache_key=None):
+        job = BackgroundJob(label, body.get('task_type'), api.inference_type)
+        cached = result_cache.get(cache_key) if cache_key else None
+        if cached:
+            job.data, job.status, job.finished = cached, 'succeed', time.time()
+            return job
+
+        job.future = self.executor.submit(self._run, job, api, body, upload, polling, result_cache, cache_key)
+        return job
+
+    def _run(self, job, api, body, upload, polling, result_cache, cache_key):
+        try:
+            if api.inference_type == 'Real-time':
+                data = api.run_inference_job(body, upload, polling, job.on_status, job.remaining)
+                self._finish(job, api, result_cache, cache_key, data)
+                return
+            inference_id, params_upload = api.launch_inference_job(body, upload, job.on_status)
+        except Exception as e:
+            self._finish(job, api, result_cache, cache_key, error=e)
+            return
+
+        def done(data, error):
+            if data is not None:
+                data = with_params_upload(api, inference_id, data, params_upload)
+            # caching may download the images: not on a poll thread
+            self.executor.submit(self._finish, job, api, result_cache, cache_key, data, error)
+
+        self.poller.watch(api, inference_id, done, polling, job.on_status, job.remaining)
+
+    def _finish(self, job, api, result_cache, cache_key, data=None, error=None):
+        try:
+            if error is not None:
+                raise error
+            job.data = data
+            if cache_key and data['status'] == 'succeed':
+                result_cache.put(cache_key, data, api, data.get('images') or None, job.task_type)
+            job.status = data['status']
+        except Exception as e:
+            logger.exception(e)
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+
+    def close(self):
+        self.poller.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class StreamingParamsBody:
+    """Single-use request body for api_params JSON whose `field` is base64-encoded on the fly
+    from `chunks` (raw bytes, `size` in total), or passed through when already `encoded`.
+
+    Only one source chunk plus up to 2 carried bytes is held at a time. The exact length is
+    known up front because presigned S3 PUTs reject chunked transfer encoding.
+    """
+
+    placeholder = '__streamed_base64_field__'
+
+    def __init__(self, api_params, field: str, chunks, size: int, encoded: bool = False):
+        serialized = dumps(dict(api_params, **{field: self.placeholder}))
+        prefix, suffix = serialized.split(dumps(self.placeholder))
+        self.prefix = prefix + b'"'
+        self.suffix = b'"' + suffix
+        self.chunks = chunks
+        self.size = size
+        self.encoded = encoded
+        self.consumed = False
+
+    def __len__(self):
+        encoded_size = self.size if self.encoded else 4 * math.ceil(self.size / 3)
+        return len(self.prefix) + encoded_size + len(self.suffix)
+
+    def __iter__(self):
+        if self.consumed:
+            raise Exception("streaming api_params body can not be replayed")
+        self.consumed = True
+
+        yield self.prefix
+        carry = b''
+        total = 0
+        if self.encoded:
+            for chunk in self.chunks:
+                total += len(chunk)
+                yield chunk
+            self.chunks = ()
+        for chunk in self.chunks:
+            total += len(chunk)
+            data = carry + chunk if carry else chunk
+            cut = len(data) - len(data) % 3
+            carry = data[cut:]
+            if cut:
+                yield base64.b64encode(data[:cut])
+        if carry:
+            yield base64.b64encode(carry)
+        if total != self.size:
+            raise Exception(f"image stream ended after {total} of {self.size} bytes")
+        yield self.suffix
+
+
+def preprocess_image(data: bytes, width: int = None, height: int = None, mask: bool = False,
+                     image_format: str = 'PNG', quality: int = None):
+    """Downscale an encoded image to cover width x height (never upscale) and re-encode it.
+
+    Images become PNG (optimized) or WebP (lossless unless `quality` is given), dropping an
+    all-opaque alpha channel; masks are binarized and stored as 1-bit PNG. Other images that
+    need no resizing are returned as is when re-encoding would not make them smaller, and
+    JPEGs are then not re-encoded losslessly at all. Needs Pillow.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise Exception("Image preprocessing needs Pillow, please pip install Pillow")
+
+    lossless = image_format.upper() != 'WEBP' or not quality
+    with Image.open(io.BytesIO(data)) as image:
+        resize = None
+        if width and height:
+            scale = max(width / image.width, height / image.height)
+            if scale < 1:
+                resize = (max(width, round(image.width * scale)), max(height, round(image.height * scale)))
+        # lossless PNG/WebP of a photo is several times its JPEG
+        if not mask and not resize and lossless and image.format == 'JPEG':
+            return data
+        image.load()
+    if resize:
+        image = image.resize(resize, Image.LANCZOS)
+
+    out = io.BytesIO()
+    if mask:
+        image.convert('L').point(lambda v: 255 if v >= 128 else 0).convert('1').save(out, 'PNG', optimize=True)
+        return out.getvalue()
+
+    if image.mode == 'RGBA' and image.getchannel('A').getextrema() == (255, 255):
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    if image_format.upper() == 'WEBP':
+        options = {'quality': quality} if quality else {'lossless': True}
+        image.save(out, 'WEBP', method=6, **options)
+    else:
+        image.save(out, 'PNG', optimize=True)
+    if not resize and out.tell() >= len(data):
+        return data
+    return out.getvalue()
+
+
+def decode_data_uri(value: str):
+    """(mime type or None, bytes) of a base64 string, with or without a data: URI prefix."""
+    if value.startswith('data:'):
+        header, value = value.split(',', 1)
+        return header[5:].split(';')[0] or None, base64.b64decode(value)
+    return None, base64.b64decode(value)
+
+
+class ImagePreprocessor:
+    """Optional input preprocessing before images are base64-ed into api_params.
+
+    Results are memoized by content hash, so a template image is processed once per process.
+    More than `pool_threshold` images at a time are processed in a process pool.
+    """
+
+    def __init__(self, image_format: str = 'PNG', quality: int = None, max_workers: int = None,
+                 pool_threshold: int = 4, memo_size: int = 64):
+        self.image_format = image_format
+        self.quality = quality
+        self.max_workers = max_workers
+        self.pool_threshold = pool_threshold
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def mime_type(self, mask: bool = False):
+        return 'image/png' if mask or self.image_format.upper() != 'WEBP' else 'image/webp'
+
+    def process(self, data: bytes, width: int = None, height: int = None, mask: bool = False):
+        return self.process_many([(data, width, height, mask)])[0]
+
+    def process_many(self, items):
+        """items are (data, width, height, mask) tuples; returns the processed bytes in order."""
+        keys = [(hashlib.sha256(data).hexdigest(), width, height, mask) for data, width, height, mask in items]
+        with self._lock:
+            results = [self._memo.get(key) for key in keys]
+        todo = [i for i, result in enumerate(results) if result is None]
+
+        args = [(items[i][0], items[i][1], items[i][2], items[i][3], self.image_format, self.quality) for i in todo]
+        if len(args) > self.pool_threshold:
+            with ProcessPoolExecutor(self.max_workers) as pool:
+                processed = list(pool.map(preprocess_image, *zip(*args)))
+        else:
+            processed = [preprocess_image(*a) for a in args]
+
+        with self._lock:
+            for i, data in zip(todo, processed):
+                results[i] = self._memo[keys[i]] = data
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return results
+
+    def process_data_uris(self, values, width: int = None, height: int = None, mask: bool = False):
+        """Same for base64 strings (optionally data: URIs), as A1111 takes them in api_params.
+        Values whose image was kept as is are returned unchanged."""
+        raw = [decode_data_uri(v)[1] for v in values]
+        processed = self.process_many([(data, width, height, mask) for data in raw])
+        prefix = f"data:{self.mime_type(mask)};base64,"
+        return [value if data == original else prefix + base64.b64encode(data).decode('ascii')
+                for value, original, data in zip(values, raw, processed)]
+
+    def img2img_overrides(self, api_params):
+        """init_images and mask of img2img api_params, fitted to its width/height."""
+        width, height = api_params.get('width'), api_params.get('height')
+        overrides = {'init_images': self.process_data_uris(api_params.get('init_images') or [], width, height)}
+        if api_params.get('mask'):
+            overrides['mask'] = self.process_data_uris([api_params['mask']], width, height, mask=True)[0]
+        return overrides
+
+
+# responses to a compressed params PUT that mean the Content-Encoding itself was refused
+encoding_rejected_statuses = (400, 415)
+
+
+def compress_params(data: bytes, encoding: str):
+    """api_params bytes in Content-Encoding `encoding` (gzip, or zstd with zstandard installed)."""
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if encoding == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd params encoding needs zstandard, please pip install zstandard")
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise Exception(f"unsupported params encoding {encoding}")
+
+
+def record_params_upload(raw: int, sent: int, encoding: str, seconds: float, labels):
+    """Count one api_params upload in metrics and return its per-job size/time record."""
+    metrics.inc('esd_params_raw_bytes', raw, encoding=encoding or 'identity', **labels)
+    metrics.inc('esd_params_sent_bytes', sent, encoding=encoding or 'identity', **labels)
+    logger.info(f"api_params upload {raw} -> {sent} bytes ({encoding or 'identity'}) in {seconds:.3f}s")
+    return {'raw_bytes': raw, 'sent_bytes': sent, 'encoding': encoding, 'seconds': round(seconds, 3)}
+
+
+def with_params_upload(api, inference_id: str, data, params_upload):
+    """Final job data with its api_params upload record. A job failing after a compressed
+    upload turns compression off on `api`: S3 stores any Content-Encoding, so the backend
+    not decoding it only shows up as failed jobs."""
+    if not params_upload:
+        return data
+    data = dict(data, params_upload=params_upload)
+    if data['status'] == 'failed' and params_upload['encoding'] and api.params_encoding:
+        logger.warning(f"job {inference_id} failed after a {params_upload['encoding']} params upload, "
+                       f"uploading params uncompressed from now on")
+        api.params_encoding = None
+    return data
+
+
+class BlobStore(abc.ABC):
+    """Content-addressed store for large binary api_params (init_images, mask).
+
+    Each unique image is uploaded once under its SHA-256 and referenced by a GET URL, which
+    A1111 fetches itself when its api_enable_requests option is on. URLs are reused until
+    `min_ttl` seconds before they expire. Subclasses implement exists/put/url.
+    """
+
+    def __init__(self, min_ttl: float = 600):
+        self.min_ttl = min_ttl
+        self._urls = {}
+        self._lock = threading.Lock()
+        self.stats = {'uploaded': 0, 'uploaded_bytes': 0, 'reused': 0, 'reused_bytes': 0}
+
+    def reference(self, data: bytes, content_type: str = None):
+        key = hashlib.sha256(data).hexdigest()
+        cached = self._urls.get(key)
+        if cached and cached[1] - self.min_ttl > time.time():
+            self._count('reused', data)
+            return cached[0]
+
+        if self.exists(key):
+            self._count('reused', data)
+        else:
+            self.put(key, data, content_type)
+            self._count('uploaded', data)
+        url = self.url(key)
+        with self._lock:
+            self._urls[key] = (url, presigned_url_expiry(url))
+        return url
+
+    def _count(self, kind: str, data: bytes):
+        with self._lock:
+            self.stats[kind] += 1
+            self.stats[kind + '_bytes'] += len(data)
+
+    def img2img_overrides(self, api_params):
+        """init_images and mask of img2img api_params replaced by references."""
+        overrides = {'init_images': [self.reference_data_uri(v) for v in api_params.get('init_images') or []]}
+        if api_params.get('mask'):
+            overrides['mask'] = self.reference_data_uri(api_params['mask'])
+        return overrides
+
+    def reference_data_uri(self, value: str):
+        content_type, data = decode_data_uri(value)
+        return self.reference(data, content_type)
+
+    @abc.abstractmethod
+    def exists(self, key: str):
+        ...
+
+    @abc.abstractmethod
+    def put(self, key: str, data: bytes, content_type: str = None):
+        ...
+
+    @abc.abstractmethod
+    def url(self, key: str):
+        ...
+
+
+class S3BlobStore(BlobStore):
+    """Blobs in `bucket` under `prefix`, referenced by presigned GET URLs. Needs boto3."""
+
+    def __init__(self, bucket: str, prefix: str = 'esd-blobs/', expires: int = 24 * 3600, client=None,
+                 min_ttl: float = 600):
+        super().__init__(min_ttl)
+        if client is None:
+            import boto3
+            client = boto3.client('s3')
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.expires = expires
+
+    def exists(self, key: str):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put(self, key: str, data: bytes, content_type: str = None):
+        extra = {'ContentType': content_type} if content_type else {}
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data, **extra)
+
+    def url(self, key: str):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.prefix + key}, ExpiresIn=self.expires)
+
+
+class HttpBlobStore(BlobStore):
+    """Blobs PUT to and served from `base_url` + sha256, e.g. the mock backend's /blobs/."""
+
+    def __init__(self, base_url: str, session=None, min_ttl: float = 600):
+        super().__init__(min_ttl)
+        self.base_url = base_url
+        self.session = session or create_session()
+
+    def exists(self, key: str):
+        return self.session.head(self.url(key), timeout=(3.05, 30)).status_code == 200
+
+    def put(self, key: str, data: bytes, content_type: str = None):
+        headers = {'Content-Type': content_type} if content_type else {}
+        self.session.put(self.url(key), data=data, headers=headers, timeout=(3.05, 30)).raise_for_status()
+
+    def url(self, key: str):
+        return self.base_url + key
+
+
+class AsyncApi:
+    """asyncio counterpart of Api: drives the create -> upload params -> start -> poll
+    lifecycle without blocking a thread per job."""
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_url: str, api_key: str, api_username: str, inference_type: str,
+                 pool_size: int = 100, timeout: float = 30, retries: int = 3, backoff_factor: float = 0.5,
+                 params_encoding: str = None, admission_controller=None):
+
+        if not api_url or not api_key or not api_username:
+            raise Exception("API URL, API KEY and API Username can not be empty")
+
+        self.api_url = api_url
+        self.api_key = api_key
+        self.api_username = api_username
+        self.inference_type = inference_type
+        self.admission = admission_controller or admission
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.jobs = JobTracker(inference_type)
+        self.params_encoding = params_encoding
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self):
+        # aiohttp is only needed by headless/batch callers, keep it out of the Streamlit import path
+        if self._session is None:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def headers(self):
+        return {
             "Content-Type": "application/json",
             "Accept": "application/json",
             'x-api-key': self.api_key
         }
 
-        st.info("payload for create inference job")
-        st.json(body, expanded=False)
+    async def request(self, method: str, url: str, endpoint: str = None, task_type: str = None, **kwargs):
+        """Returns (status, headers, body bytes), retrying 429s and, for GETs, 5xx with exponential
+        backoff. `endpoint` (create, start or status) routes every attempt through admission control."""
+        attempt = 0
+        while True:
+            if endpoint is not None:
+                await self.admission.acquire_async(endpoint, task_type)
+            async with self.session.request(method, url, **kwargs) as response:
+                body = await response.read()
+                if endpoint is not None:
+                    self.admission.record(endpoint, task_type, response.status)
+                retry = response.status == 429 or (method == 'GET' and response.status in self.retry_statuses)
+                if not retry or attempt >= self.retries:
+                    return response.status, response.headers, body
+                delay = retry_after_seconds(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = self.backoff_factor * (2 ** attempt)
+            attempt += 1
+            metrics.inc('esd_retries', method=method, inference_type=self.inference_type)
+            logger.info(f"{method} {url} retry {attempt} in {delay}s")
+            await asyncio.sleep(delay)
+
+    async def get_inference_job(self, inference_id: str):
+        url = self.api_url + "inferences/" + inference_id
+        status, headers, body = await self.request('GET', url, 'status', headers=self.headers())
+        return loads(body)
+
+    async def start_inference_job(self, inference_id: str):
+        url = self.api_url + 'inferences/' + inference_id + '/start'
+        with metrics.time('esd_job_phase_seconds', phase='start', **self.jobs.labels(inference_id)):
+            status, headers, body = await self.request('PUT', url, 'start', headers=self.headers())
+        run_resp = loads(body)
+        if status >= 400 and 'errorMessage' not in run_resp:
+            raise Exception(f"start inference job {inference_id} failed with HTTP {status}: {run_resp.get('message')}")
+        self.jobs.started(inference_id)
+        return run_resp
 
-        job = requests.post(self.api_url + "inferences", headers=headers, json=body)
-        st.info(f"create inference job response\nPOST {self.api_url}inferences")
-        st.json(job.json(), expanded=False)
+    async def create_inference_job(self, body):
+        labels = {'task_type': body.get('task_type', 'unknown'), 'inference_type': self.inference_type}
+        with metrics.time('esd_job_phase_seconds', phase='create', **labels):
+            status, headers, resp = await self.request('POST', self.api_url + "inferences", 'create',
+                                                       labels['task_type'], headers=self.headers(), data=dumps(body))
 
-        if job.status_code == 403:
+        if status == 403:
             raise Exception(f"Your API URL or API KEY is not correct. Please check your .env file.")
 
-        return job.json()
+        job = loads(resp)
+        self.jobs.created(body, job)
+        if status >= 400 and job.get('statusCode') != 400:
+            raise Exception(f"create inference job failed with HTTP {status}: {job.get('message')}")
+        return job
+
+    async def upload_api_params(self, s3_url: str, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        labels = self.jobs.labels(s3_url)
+        encoding = self.params_encoding
+        started = time.monotonic()
+        with metrics.time('esd_job_phase_seconds', phase='upload', **labels):
+            if encoding:
+                sent = compress_params(data, encoding)
+                status, headers, body = await self.request('PUT', s3_url, data=sent,
+                                                           headers={'Content-Encoding': encoding})
+                if status in encoding_rejected_statuses:
+                    logger.warning(f"{encoding} params upload rejected with HTTP {status}, "
+                                   f"uploading params uncompressed from now on")
+                    self.params_encoding = encoding = None
+            if not encoding:
+                sent = data
+                status, headers, body = await self.request('PUT', s3_url, data=sent)
+        self.jobs.forget(s3_url)
+        if status >= 400:
+            raise Exception(f"upload api params failed with HTTP {status}: {body[:200]!r}")
+        return record_params_upload(len(data), len(sent), encoding, time.monotonic() - started, labels)
+
+    async def download_results(self, urls, directory: str = None, prefix: str = '', stats=None,
+                               task_type: str = 'unknown'):
+        """Concurrently download result images to `directory` (or memory), verifying
+        Content-Length. Same result dicts as ResultFetcher.fetch; totals added to `stats`."""
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        async def download(index, url):
+            started = time.monotonic()
+            path = os.path.join(directory, prefix + result_file_name(url, index)) if directory else None
+            async with self.session.get(url) as response:
+                if response.status != 200:
+                    raise Exception(f"get result image {url} failed with HTTP {response.status}")
+                # aiohttp decodes a Content-Encoding, so the length only holds for identity bodies
+                expected = None if response.headers.get('Content-Encoding') else response.content_length
+                chunks = [] if path is None else None
+                size = 0
+                with open(path + '.part', 'wb') if path else contextlib.nullcontext() as out:
+                    async for chunk in response.content.iter_chunked(256 * 1024):
+                        size += len(chunk)
+                        if path:
+                            out.write(chunk)
+                        else:
+                            chunks.append(chunk)
+            if expected is not None and expected != size:
+                raise Exception(f"result image {url} truncated: got {size} of {expected} bytes")
+            seconds = time.monotonic() - started
+            metrics.observe('esd_job_phase_seconds', seconds, phase='download', task_type=task_type,
+                            inference_type=self.inference_type)
+            if stats is not None:
+                stats['images'] = stats.get('images', 0) + 1
+                stats['bytes'] = stats.get('bytes', 0) + size
+                stats['seconds'] = stats.get('seconds', 0.0) + seconds
+            result = {'url': url, 'bytes': size, 'seconds': seconds}
+            if path:
+                os.replace(path + '.part', path)
+                result['path'] = path
+            else:
+                result['data'] = b''.join(chunks)
+            return result
+
+        return await asyncio.gather(*[download(i, url) for i, url in enumerate(urls)])
+
+    async def wait_for_inference_job(self, inference_id: str, polling=None, on_status=None, max_errors: int = 5):
+        polling = polling or PollingStrategy()
+        url = self.api_url + "inferences/" + inference_id
+        attempt = 0
+        errors = 0
+        while True:
+            with metrics.time('esd_job_phase_seconds', phase='poll', **self.jobs.labels(inference_id)):
+                status, headers, body = await self.request('GET', url, 'status', headers=self.headers())
+            check_poll_status(inference_id, status, errors, max_errors)
+            errors = 0 if status < 400 else errors + 1
+            if status < 400:
+                data = loads(body)['data']
+                logger.debug(f"job {inference_id} status: {data['status']}")
+                self.jobs.status(inference_id, data['status'])
+                if on_status:
+                    on_status(data)
+                if data['status'] in ('succeed', 'failed'):
+                    return data
+            await asyncio.sleep(polling.interval(attempt, retry_after_seconds(headers.get('Retry-After'))))
+            attempt += 1
+
+    async def run_inference_job(self, body, api_params, polling=None, scheduler=None, result_cache=None):
+        """Full lifecycle for one job, returns the final job data (status succeed or failed).
+
+        With a StatusScheduler the wait is handed to it instead of a per-job poll loop. With a
+        ResultCache, deterministic requests already run are answered without a new job."""
+        cache_key = result_cache.key(body, api_params) if result_cache is not None else None
+        if cache_key:
+            cached = result_cache.get(cache_key)
+            if cached:
+                return cached
+
+        data = await self._run_inference_job(body, api_params, polling, scheduler)
+
+        if cache_key and data['status'] == 'succeed':
+            images = []
+            if result_cache.store_images:
+                images = [r['data'] for r in await self.download_results(data.get('img_presigned_urls') or [],
+                                                                         task_type=body.get('task_type', 'unknown'))]
+            result_cache.put(cache_key, data, images=images)
+        return data
+
+    async def _run_inference_job(self, body, api_params, polling, scheduler):
+        job = await self.create_inference_job(body)
+        if job['statusCode'] == 400:
+            raise Exception(job['message'])
+
+        inference = job['data']['inference']
+        api_params = encode_api_params(api_params)
+        params_upload = await self.upload_api_params(inference['api_params_s3_upload_url'], api_params)
+
+        run_resp = await self.start_inference_job(inference['id'])
+        if 'errorMessage' in run_resp:
+            raise Exception(run_resp['errorMessage'])
+
+        if self.inference_type == 'Real-time':
+            data = dict(run_resp['data'], status='succeed')
+        elif scheduler is not None:
+            data = await scheduler.watch(inference['id'], polling=polling)
+        else:
+            data = await self.wait_for_inference_job(inference['id'], polling)
+        return with_params_upload(self, inference['id'], data, params_upload)
+
+
+class StatusScheduler:
+    """Single owner of status polling for many in-flight jobs.
+
+    Jobs sit in a heap keyed by their next check time; due jobs are polled with at most
+    `max_concurrency` status requests in flight and, optionally, no more than `max_rate`
+    requests per second. watch() returns a future resolved with the job data once it is
+    succeed or failed, or failed on a 4xx other than 429 or after `max_errors` failed polls
+    in a row.
+    """
+
+    def __init__(self, api: AsyncApi, polling=None, max_concurrency: int = 10, max_rate: float = None,
+                 max_errors: int = 5):
+        self.api = api
+        self.polling = polling or PollingStrategy()
+        self.max_concurrency = max_concurrency
+        self.max_rate = max_rate
+        self.max_errors = max_errors
+        self._heap = []
+        self._jobs = {}
+        self._seq = 0
+        self._wakeup = None
+        self._slots = None
+        self._task = None
+        self._checks = set()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._checks, return_exceptions=True)
+            self._task = None
+        for job in self._jobs.values():
+            if not job['future'].done():
+                job['future'].cancel()
+        self._jobs.clear()
+        self._heap.clear()
+
+    def watch(self, inference_id: str, callback=None, polling=None, delay: float = None):
+        """Start tracking a job. callback(data) is called on the final status as well."""
+        self.start()
+        if inference_id in self._jobs:
+            return self._jobs[inference_id]['future']
+
+        polling = polling or self.polling
+        future = asyncio.get_running_loop().create_future()
+        self._jobs[inference_id] = {'future': future, 'callback': callback, 'polling': polling,
+                                    'attempt': 0, 'errors': 0}
+        self._schedule(inference_id, polling.interval(0) if delay is None else delay)
+        return future
+
+    def _schedule(self, inference_id: str, delay: float):
+        self._seq += 1
+        heapq.heappush(self._heap, (asyncio.get_running_loop().time() + delay, self._seq, inference_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_dispatch = 0.0
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            due = self._heap[0][0]
+            if self.max_rate:
+                due = max(due, last_dispatch + 1 / self.max_rate)
+            wait = due - loop.time()
+            if wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, inference_id = heapq.heappop(self._heap)
+            job = self._jobs.get(inference_id)
+            if job is None or job['future'].done():
+                self._jobs.pop(inference_id, None)
+                continue
+
+            await self._slots.acquire()
+            last_dispatch = loop.time()
+            check = asyncio.ensure_future(self._check(inference_id, job))
+            self._checks.add(check)
+            check.add_done_callback(self._checks.discard)
+
+    async def _check(self, inference_id: str, job):
+        retry_after = None
+        try:
+            with metrics.time('esd_job_phase_seconds', phase='poll', **self.api.jobs.labels(inference_id)):
+                status, headers, body = await self.api.request(
+                    'GET', self.api.api_url + "inferences/" + inference_id, 'status', headers=self.api.headers())
+            retry_after = retry_after_seconds(headers.get('Retry-After'))
+            if status >= 400:
+                try:
+                    check_poll_status(inference_id, status, job['errors'], self.max_errors)
+                except Exception as e:
+                    self._finish(inference_id, job, error=e)
+                    return
+                raise Exception(f"get inference job {inference_id} failed with HTTP {status}")
+            data = loads(body)['data']
+            job['errors'] = 0
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job['errors'] += 1
+            if job['errors'] >= self.max_errors:
+                self._finish(inference_id, job, error=e)
+                return
+            data = None
+        finally:
+            self._slots.release()
+
+        if data is not None:
+            self.api.jobs.status(inference_id, data['status'])
+            if job['callback']:
+                try:
+                    job['callback'](data)
+                except Exception as e:
+                    # a broken callback must not strand the job: keep polling and resolve it
+                    logger.exception(f"status callback for job {inference_id} failed: {e}")
+            if data['status'] in ('succeed', 'failed'):
+                self._finish(inference_id, job, data)
+                return
+
+        job['attempt'] += 1
+        self._schedule(inference_id, job['polling'].interval(job['attempt'], retry_after))
+
+    def _finish(self, inference_id: str, job, data=None, error=None):
+        self._jobs.pop(inference_id, None)
+        if job['future'].done():
+            return
+        if error is not None:
+            job['future'].set_exception(error)
+        else:
+            job['future'].set_result(data)
+
+
+class JobPipeline:
+    """Job lifecycle split into stages (create -> upload params -> start -> wait) with a
+    bounded queue in front of each stage and its own worker count, so the control-plane
+    round-trips of later jobs overlap the start and polling of earlier ones.
+
+    Waiting is owned by a StatusScheduler; results of deterministic requests come from
+    `result_cache` when given.
+    """
+
+    def __init__(self, api: AsyncApi, scheduler: StatusScheduler = None, create_workers: int = 4,
+                 upload_workers: int = 4, start_workers: int = 4, queue_size: int = 16, result_cache=None):
+        self.api = api
+        self.scheduler = scheduler
+        self.result_cache = result_cache
+        self.workers = {'create': create_workers, 'upload': upload_workers, 'start': start_workers}
+        self.queue_size = queue_size
+        self._owns_scheduler = scheduler is None
+        self._queues = None
+        self._tasks = []
+        self._stores = set()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def start(self):
+        if self._queues is not None:
+            return
+        if self.scheduler is None:
+            self.scheduler = StatusScheduler(self.api)
+        self.scheduler.start()
+        self._queues = {stage: asyncio.Queue(self.queue_size) for stage in self.workers}
+        handlers = {'create': self._create, 'upload': self._upload, 'start': self._start}
+        for stage, count in self.workers.items():
+            for _ in range(count):
+                self._tasks.append(asyncio.ensure_future(self._work(stage, handlers[stage])))
+
+    async def close(self):
+        # let pending result cache writes finish before tearing down
+        await asyncio.gather(*self._stores, return_exceptions=True)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queues = None
+        if self._owns_scheduler and self.scheduler is not None:
+            await self.scheduler.close()
+
+    async def submit(self, body, api_params):
+        """Queue a job; waits while the create queue is full. Returns a future with the final
+        job data (status succeed or failed)."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+
+        cache_key = self.result_cache.key(body, api_params) if self.result_cache is not None else None
+        cached = self.result_cache.get(cache_key) if cache_key else None
+        if cached:
+            future.set_result(cached)
+            return future
+        if cache_key:
+            future.add_done_callback(lambda f: self._remember(cache_key, f, body.get('task_type', 'unknown')))
+
+        await self._queues['create'].put((future, body, api_params))
+        return future
+
+    async def run(self, body, api_params):
+        return await (await self.submit(body, api_params))
+
+    async def _work(self, stage: str, handler):
+        queue = self._queues[stage]
+        while True:
+            item = await queue.get()
+            future = item[0]
+            try:
+                if not future.done():
+                    await handler(*item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    async def _create(self, future, body, api_params):
+        job = await self.api.create_inference_job(body)
+        if job['statusCode'] == 400:
+            raise Exception(job['message'])
+        await self._queues['upload'].put((future, job['data']['inference'], api_params))
+
+    async def _upload(self, future, inference, api_params):
+        api_params = encode_api_params(api_params)
+        params_upload = await self.api.upload_api_params(inference['api_params_s3_upload_url'], api_params)
+        await self._queues['start'].put((future, inference, params_upload))
+
+    async def _start(self, future, inference, params_upload):
+        run_resp = await self.api.start_inference_job(inference['id'])
+        if 'errorMessage' in run_resp:
+            raise Exception(run_resp['errorMessage'])
+
+        if self.api.inference_type == 'Real-time':
+            data = dict(run_resp['data'], status='succeed')
+            future.set_result(with_params_upload(self.api, inference['id'], data, params_upload))
+            return
+
+        watched = self.scheduler.watch(inference['id'])
+        watched.add_done_callback(lambda w: self._resolve(future, w, inference['id'], params_upload))
+
+    def _resolve(self, future, watched, inference_id: str, params_upload):
+        if future.done():
+            return
+        if watched.cancelled():
+            future.cancel()
+        elif watched.exception() is not None:
+            future.set_exception(watched.exception())
+        else:
+            future.set_result(with_params_upload(self.api, inference_id, watched.result(), params_upload))
+
+    def _remember(self, cache_key: str, future, task_type: str):
+        if future.cancelled() or future.exception() is not None or future.result()['status'] != 'succeed':
+            return
+        store = asyncio.ensure_future(self._store(cache_key, future.result(), task_type))
+        self._stores.add(store)
+        store.add_done_callback(self._stores.discard)
+
+    async def _store(self, cache_key: str, data, task_type: str):
+        images = []
+        if self.result_cache.store_images:
+            images = [r['data'] for r in await self.api.download_results(data.get('img_presigned_urls') or [],
+                                                                         task_type=task_type)]
+        self.result_cache.put(cache_key, data, images=images)
+
+
+class Metrics:
+    """In-process job lifecycle metrics, exported as OpenMetrics text.
+
+    Histograms (e.g. esd_job_phase_seconds by phase, task_type and inference_type) and
+    counters (retries, failed jobs, statusCode 400 responses). Every sample is also passed
+    to the hooks registered with add_hook(fn), called as fn(kind, name, value, labels).
+    """
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._hooks = []
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            histogram['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        for hook in self._hooks:
+            hook('histogram', name, value, labels)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        for hook in self._hooks:
+            hook('counter', name, value, labels)
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {k: {'buckets': list(v['buckets']), 'sum': v['sum'], 'count': v['count']}
+                          for k, v in self._histograms.items()}
+            return histograms, dict(self._counters)
+
+    def render(self):
+        histograms, counters = self.snapshot()
+        lines = []
+        for name in sorted({k[0] for k in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            if name.endswith('_seconds'):
+                lines.append(f"# UNIT {name} seconds")
+            for (n, labels), histogram in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f"{name}_bucket{openmetrics_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_count{openmetrics_labels(labels)} {histogram['count']}")
+                lines.append(f"{name}_sum{openmetrics_labels(labels)} {histogram['sum']}")
+        for name in sorted({k[0] for k in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}_total{openmetrics_labels(labels)} {value}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port: int = 9108, address: str = ''):
+        """Expose render() over HTTP on a daemon thread; returns the server."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+def openmetrics_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics()
+
+
+class JobTracker:
+    """Per-client record of created jobs: task type by inference id (and by params upload URL)
+    for metric labels, and how long each job spends in created and running."""
+
+    terminal = ('succeed', 'failed')
+
+    def __init__(self, inference_type: str):
+        self.inference_type = inference_type
+        self._task_types = {}
+        self._clocks = {}
+        self._lock = threading.Lock()
+
+    def labels(self, key: str):
+        return {'task_type': self._task_types.get(key, 'unknown'), 'inference_type': self.inference_type}
+
+    def created(self, body, job):
+        task_type = body.get('task_type', 'unknown')
+        if job.get('statusCode') == 400:
+            metrics.inc('esd_bad_requests', task_type=task_type, inference_type=self.inference_type)
+            return
+        inference = (job.get('data') or {}).get('inference') or {}
+        with self._lock:
+            if 'id' in inference:
+                self._task_types[inference['id']] = task_type
+            if 'api_params_s3_upload_url' in inference:
+                self._task_types[inference['api_params_s3_upload_url']] = task_type
+
+    def started(self, inference_id: str):
+        with self._lock:
+            self._clocks.setdefault(inference_id, ['created', time.monotonic()])
+
+    def status(self, inference_id: str, status: str):
+        now = time.monotonic()
+        with self._lock:
+            clock = self._clocks.setdefault(inference_id, ['created', now])
+            previous, since = clock
+            if status == previous:
+                return
+            clock[:] = [status, now]
+        labels = self.labels(inference_id)
+        if previous == 'created':
+            metrics.observe('esd_job_phase_seconds', now - since, phase='created', **labels)
+        elif status in self.terminal:
+            metrics.observe('esd_job_phase_seconds', now - since, phase='running', **labels)
+        if status == 'failed':
+            metrics.inc('esd_job_failures', **labels)
+        if status in self.terminal:
+            self.forget(inference_id)
+
+    def forget(self, inference_id: str):
+        with self._lock:
+            self._clocks.pop(inference_id, None)
+            self._task_types.pop(inference_id, None)
+
+
+class LatencyEstimator:
+    """EWMA of how long jobs stay created and running, per task type and inference type.
+
+    Fed by the esd_job_phase_seconds samples (it is a Metrics hook), so every job this
+    process tracks improves the ETA of the next ones.
+    """
+
+    phases = ('created', 'running')
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self._estimates = {}
+
+    def __call__(self, kind, name, value, labels):
+        if name == 'esd_job_phase_seconds' and labels.get('phase') in self.phases:
+            self.observe(labels['phase'], labels.get('task_type'), labels.get('inference_type'), value)
+
+    def observe(self, phase: str, task_type: str, inference_type: str, seconds: float):
+        key = (phase, task_type, inference_type)
+        previous = self._estimates.get(key)
+        self._estimates[key] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+
+    def estimate(self, phase: str, task_type: str, inference_type: str):
+        return self._estimates.get((phase, task_type, inference_type))
+
+
+latency_estimates = LatencyEstimator()
+metrics.add_hook(latency_estimates)
+
+
+class PollingStrategy:
+    """Exponential backoff with jitter between status polls.
+
+    Starts at `initial` seconds so short jobs (e.g. LCM) are picked up quickly, grows by
+    `factor` per poll up to `max_interval`, and never polls sooner than a server Retry-After.
+    With an estimate of the `remaining` seconds, polls sparsely while the job is far from its
+    expected end and every `initial` seconds around it instead.
+    """
+
+    def __init__(self, initial: float = 1.0, factor: float = 1.5, max_interval: float = 10.0, jitter: float = 0.2):
+        self.initial = initial
+        self.factor = factor
+        self.max_interval = max_interval
+        self.jitter = jitter
+
+    def interval(self, attempt: int, retry_after: float = None, remaining: float = None):
+        if remaining is not None:
+            delay = min(self.max_interval, max(self.initial, remaining / 2))
+        else:
+            delay = min(self.max_interval, self.initial * self.factor ** attempt)
+        delay = min(self.max_interval, delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class TokenBucket:
+    """`rate` requests per second in bursts of up to `burst`, handed out as booked slots
+    (GCRA): a caller takes the earliest free slot, later callers queue up behind it."""
+
+    __slots__ = ('rate', 'max_rate', 'burst', 'tat', 'decreased')
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        # theoretical arrival time of the next request at `rate`
+        self.tat = 0.0
+        self.decreased = 0.0
+
+    def earliest(self, now: float):
+        return max(now, self.tat - (self.burst - 1) / self.rate)
+
+    def take(self, start: float):
+        self.tat = max(self.tat, start) + 1 / self.rate
+
+
+class AdmissionController:
+    """Client-side pacing of ESD API calls, shared by every Api and AsyncApi in the process.
+
+    Token buckets per endpoint (create, start, status) and per task type on create admit
+    requests before they are sent. A caller books the next free slot of every bucket it
+    needs and sleeps until then, so waiting callers go out in arrival order and know their
+    wait up front; with `max_wait` a longer wait raises instead. A 429 multiplies the rates
+    involved by `decrease` (once per `cooldown` seconds), every success adds back about
+    `increase` requests/s per second up to the configured rate (AIMD).
+    """
+
+    default_rates = {'create': 10, 'start': 10, 'status': 50}
+
+    def __init__(self, rates=None, task_rates=None, task_rate: float = 10, burst: int = 10,
+                 min_rate: float = 0.5, decrease: float = 0.5, increase: float = 1.0, cooldown: float = 1.0,
+                 max_wait: float = None):
+        self.rates = dict(self.default_rates if rates is None else rates)
+        self.task_rates = dict(task_rates or {})
+        self.task_rate = task_rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_spec(cls, spec: str = None, **kwargs):
+        """From e.g. "create=5,status=20,task=4,img2img=1": endpoint rates, `task` for every
+        task type, any other name for that task type; "off" disables admission control."""
+        if not spec:
+            return cls(**kwargs)
+        if spec.strip().lower() == 'off':
+            return cls(rates={}, task_rate=None, **kwargs)
+        rates = dict(cls.default_rates)
+        task_rates = {}
+        for item in spec.split(','):
+            name, _, value = item.partition('=')
+            name = name.strip()
+            if name in rates:
+                rates[name] = float(value)
+            elif name == 'task':
+                kwargs['task_rate'] = float(value)
+            else:
+                task_rates[name] = float(value)
+        return cls(rates, task_rates, **kwargs)
+
+    def buckets(self, endpoint: str, task_type: str = None):
+        keys = [('endpoint', endpoint, self.rates.get(endpoint))]
+        if task_type is not None:
+            keys.append(('task_type', task_type, self.task_rates.get(task_type, self.task_rate)))
+        buckets = []
+        for kind, name, rate in keys:
+            if not rate:
+                continue
+            bucket = self._buckets.get((kind, name))
+            if bucket is None:
+                bucket = self._buckets[(kind, name)] = TokenBucket(rate, self.burst)
+            buckets.append(bucket)
+        return buckets
+
+    def reserve(self, endpoint: str, task_type: str = None):
+        """Book the next slot for a call to `endpoint`; returns the seconds to wait for it."""
+        with self._lock:
+            buckets = self.buckets(endpoint, task_type)
+            now = time.monotonic()
+            start = max((bucket.earliest(now) for bucket in buckets), default=now)
+            if self.max_wait is not None and start - now > self.max_wait:
+                raise Exception(f"{endpoint} calls are queued for {start - now:.1f}s, "
+                                f"more than the {self.max_wait}s allowed")
+            for bucket in buckets:
+                bucket.take(start)
+        metrics.observe('esd_admission_wait_seconds', start - now, endpoint=endpoint)
+        return start - now
+
+    def acquire(self, endpoint: str, task_type: str = None):
+        wait = self.reserve(endpoint, task_type)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, endpoint: str, task_type: str = None):
+        wait = self.reserve(endpoint, task_type)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record(self, endpoint: str, task_type: str = None, status: int = 200, throttled: bool = False):
+        """Adapt the rates after a response: decrease on 429 (or `throttled` retries), increase on success."""
+        throttled = throttled or status == 429
+        if not throttled and status >= 400:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for bucket in self.buckets(endpoint, task_type):
+                if not throttled:
+                    bucket.rate = min(bucket.max_rate, bucket.rate + self.increase / bucket.rate)
+                elif now - bucket.decreased >= self.cooldown:
+                    bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+                    bucket.decreased = now
+        if throttled:
+            logger.info(f"{endpoint} throttled, admission rates now {self.stats()}")
+            metrics.inc('esd_throttled', endpoint=endpoint)
+
+    def stats(self):
+        with self._lock:
+            return {f"{kind}:{name}": round(bucket.rate, 2) for (kind, name), bucket in self._buckets.items()}
+
+
+try:
+    admission = AdmissionController.from_spec(os.getenv("API_RATES"))
+except ValueError as e:
+    logger.error(f"ignoring malformed API_RATES {os.getenv('API_RATES')!r} ({e}), using the default rates")
+    admission = AdmissionController()
+
+
+def check_poll_status(inference_id: str, status: int, errors: int, max_errors: int = 5):
+    """Raise for a status poll answered `status` after `errors` failed polls in a row:
+    4xx other than 429 at once, 429/5xx once they reach `max_errors`."""
+    if status < 400:
+        return
+    if status != 429 and status < 500:
+        raise Exception(f"get inference job {inference_id} failed with HTTP {status}")
+    if errors + 1 >= max_errors:
+        raise Exception(f"get inference job {inference_id} failed {errors + 1} times in a row, last with HTTP {status}")
+
+
+def retry_after_seconds(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def create_session(pool_size: int = 10, retries: int = 3, backoff_factor: float = 0.5):
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        # 429s are left to Api.request, which retries them through admission control
+        status_forcelist=(500, 502, 503, 504),
+        # read timeouts and 5xx are only retried for GETs: a resent create POST or Real-time
+        # start PUT may run another job; connect errors (nothing sent) are retried for all
+        allowed_methods=frozenset(['GET']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def freeze(value):
+    """Read-only deep copy of value: mappings become MappingProxyType, lists tuples."""
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class ParamsTemplate:
+    """Frozen api_params defaults shared by every job.
+
+    Each top-level `"key": value` fragment is serialized once at construction; encode()
+    joins the cached fragments and serializes only the overridden values, producing the
+    same bytes as dumps() on the merged dict.
+    """
+
+    __slots__ = ('defaults', 'fragments')
+
+    def __init__(self, defaults):
+        # deep-frozen: a nested value (alwayson_scripts, ControlNet units) changed in place would
+        # silently disagree with its cached fragment
+        self.defaults = freeze(defaults)
+        self.fragments = {k: self.fragment(k, v) for k, v in self.defaults.items()}
+
+    @staticmethod
+    def fragment(key: str, value):
+        return dumps(key) + b':' + dumps(value)
+
+    def derive(self, **overrides):
+        return ParamsTemplate(dict(self.defaults, **overrides))
+
+    def encode(self, overrides):
+        fragments = self.fragments
+        parts = [self.fragment(k, overrides[k]) if k in overrides else fragment for k, fragment in fragments.items()]
+        parts.extend(self.fragment(k, v) for k, v in overrides.items() if k not in fragments)
+        return b'{' + b','.join(parts) + b'}'
+
+
+class ApiParams(Mapping):
+    """Per-job api_params: a few overrides (prompt, seed, steps...) over a shared ParamsTemplate.
+
+    Reads fall through to the template defaults; nothing is copied per job.
+    """
+
+    __slots__ = ('template', 'overrides')
+
+    def __init__(self, template: ParamsTemplate, **overrides):
+        self.template = template
+        self.overrides = overrides
+
+    def __getitem__(self, key):
+        if key in self.overrides:
+            return self.overrides[key]
+        return self.template.defaults[key]
+
+    def __iter__(self):
+        yield from self.template.defaults
+        yield from (k for k in self.overrides if k not in self.template.defaults)
+
+    def __len__(self):
+        return len(self.template.defaults) + sum(1 for k in self.overrides if k not in self.template.defaults)
+
+    def encode(self):
+        return self.template.encode(self.overrides)
+
+
+class TemplateRegistry:
+    """api_params templates (e.g. img2img_api_param.json) parsed once and shared.
+
+    A template is re-read only when its file mtime changes. render() returns ApiParams over
+    the shared, pre-encoded template, so large values such as base64 init_images are never
+    re-parsed, copied or re-serialized per job.
+    """
+
+    def __init__(self, base_dir: str = None):
+        self.base_dir = base_dir or os.path.dirname(os.path.abspath(__file__))
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def path(self, name: str):
+        return name if os.path.isabs(name) else os.path.join(self.base_dir, name)
+
+    def get(self, name: str):
+        path = self.path(name)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._cache.get(path)
+        if cached is None or cached[0] != mtime:
+            with self._lock:
+                cached = self._cache.get(path)
+                if cached is None or cached[0] != mtime:
+                    with open(path, 'rb') as f:
+                        cached = (mtime, ParamsTemplate(loads(f.read())))
+                    self._cache[path] = cached
+                    logger.info(f"loaded api params template {path}")
+        return cached[1].defaults
+
+    def template(self, name: str):
+        self.get(name)
+        return self._cache[self.path(name)][1]
+
+    def render(self, name: str, **overrides):
+        return ApiParams(self.template(name), **overrides)
+
+
+templates = TemplateRegistry()
+
+
+# task types of the five pages, see task_inference_body
+task_types = ('txt2img', 'txt2img-lcm', 'img2img', 'extra-single-image', 'rembg')
+
+
+def task_inference_body(api_username: str, inference_type: str, task_type: str):
+    """Create body the `task_type` page sends, so warm pool jobs match its requests."""
+    if task_type == 'txt2img':
+        return txt2img_inference_body(api_username, inference_type)
+    models = {'Stable-diffusion': [default_model]}
+    if task_type == 'txt2img-lcm':
+        task_type = 'txt2img'
+        models.update({'Lora': ['lcm_lora_1_5.safetensors'], 'embeddings': []})
+    elif task_type == 'img2img':
+        models.update({'VAE': ['Automatic'], 'embeddings': []})
+    return {
+        'user_id': api_username,
+        'task_type': task_type,
+        'inference_type': inference_type,
+        'models': models,
+        'filters': {
+            'createAt': datetime.now().timestamp(),
+            'creator': 'sd-webui'
+        }
+    }
+
+
+def txt2img_inference_body(api_username: str, inference_type: str, models=None):
+    return {
+        'user_id': api_username,
+        "task_type": "txt2img",
+        'inference_type': inference_type,
+        "models": models or {
+            "Stable-diffusion": [default_model],
+            "embeddings": []
+        },
+        "filters": {
+            "createAt": datetime.now().timestamp(),
+            "creator": "sd-webui"
+        }
+    }
+
+
+txt2img_controlnet_unit = {
+    "enabled": False,
+    "module": "none",
+    "model": "None",
+    "weight": 1,
+    "image": None,
+    "resize_mode": "Crop and Resize",
+    "low_vram": False,
+    "processor_res": -1,
+    "threshold_a": -1,
+    "threshold_b": -1,
+    "guidance_start": 0,
+    "guidance_end": 1,
+    "pixel_perfect": False,
+    "control_mode": "Balanced",
+    "is_ui": True,
+    "input_mode": "simple",
+    "batch_images": "",
+    "output_dir": "",
+    "loopback": False
+}
+
+txt2img_template = ParamsTemplate({
+    "prompt": "",
+    "negative_prompt": "",
+    "styles": [],
+    "seed": -1,
+    "subseed": -1,
+    "subseed_strength": 0.0,
+    "seed_resize_from_h": -1,
+    "seed_resize_from_w": -1,
+    "sampler_name": "DPM++ 2M Karras",
+    "batch_size": 1,
+    "n_iter": 1,
+    "steps": 20,
+    "cfg_scale": 7.0,
+    "width": 512,
+    "height": 512,
+    "restore_faces": None,
+    "tiling": None,
+    "do_not_save_samples": False,
+    "do_not_save_grid": False,
+    "eta": None,
+    "denoising_strength": None,
+    "s_min_uncond": 0.0,
+    "s_churn": 0.0,
+    "s_tmax": "Infinity",
+    "s_tmin": 0.0,
+    "s_noise": 1.0,
+    "override_settings": {},
+    "override_settings_restore_afterwards": True,
+    "refiner_checkpoint": None,
+    "refiner_switch_at": None,
+    "disable_extra_networks": False,
+    "comments": {},
+    "enable_hr": False,
+    "firstphase_width": 0,
+    "firstphase_height": 0,
+    "hr_scale": 2.0,
+    "hr_upscaler": "Latent",
+    "hr_second_pass_steps": 0,
+    "hr_resize_x": 0,
+    "hr_resize_y": 0,
+    "hr_checkpoint_name": None,
+    "hr_sampler_name": None,
+    "hr_prompt": "",
+    "hr_negative_prompt": "",
+    "sampler_index": "DPM++ 2M Karras",
+    "script_name": None,
+    "script_args": [],
+    "send_images": True,
+    "save_images": False,
+    "alwayson_scripts": {
+        "refiner": {
+            "args": [False, "", 0.8]
+        },
+        "seed": {
+            "args": [-1, False, -1, 0, 0, 0]
+        },
+        "controlnet": {
+            "args": [txt2img_controlnet_unit] * 3
+        },
+        "extra options": {
+            "args": []
+        }
+    }
+})
+
+txt2img_lcm_template = txt2img_template.derive(sampler_name="LCM", steps=4, cfg_scale=1.0)
+
+
+def txt2img_api_params(prompt: str, template=None, **overrides):
+    return ApiParams(template or txt2img_template, prompt=prompt, **overrides)
+
+
+def encode_api_params(api_params):
+    """Serialized api_params for the S3 upload; ApiParams splice into pre-encoded bytes."""
+    if isinstance(api_params, (str, bytes)):
+        return api_params
+    if isinstance(api_params, ApiParams):
+        return api_params.encode()
+    return dumps(api_params)
+
+
+def is_base64_blob(value) -> bool:
+    return isinstance(value, str) and len(value) > 256 and base64_re.fullmatch(value[:512]) is not None
+
+
+def elide_base64(payload):
+    """Copy of payload with every base64 blob replaced by a short size/hash placeholder."""
+    if isinstance(payload, Mapping):
+        return {k: elide_base64(v) for k, v in payload.items()}
+    if isinstance(payload, (list, tuple)):
+        return [elide_base64(v) for v in payload]
+    if is_base64_blob(payload):
+        digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]
+        return f"<base64 {len(payload)} chars sha256:{digest}>"
+    return payload
+
+
+def summarize_payload(payload, serialized=None):
+    if isinstance(payload, LazyJSON):
+        # a response body: summarize the bytes without parsing them
+        payload, serialized = payload.raw, serialized or payload.raw
+    if serialized is None:
+        serialized = payload if isinstance(payload, (str, bytes)) else encode_api_params(payload)
+    if isinstance(serialized, str):
+        serialized = serialized.encode('utf-8')
+    summary = {
+        'bytes': len(serialized),
+        'sha256': hashlib.sha256(serialized).hexdigest()[:12],
+    }
+    if isinstance(payload, Mapping):
+        summary['keys'] = len(payload)
+        summary['base64_fields'] = [k for k, v in payload.items()
+                                    if is_base64_blob(v) or (isinstance(v, (list, tuple)) and any(map(is_base64_blob, v)))]
+    return summary
+
+
+def show_payload(title: str, payload, serialized=None):
+    """Render a payload in the page: a size/hash summary by default, the full payload with
+    base64 elided when DEBUG is set. Never ships raw image blobs over the websocket."""
+    st.info(title)
+    if DEBUG:
+        if isinstance(payload, (str, bytes)):
+            payload = loads(payload)
+        st.json(elide_base64(payload), expanded=False)
+    else:
+        st.caption(json.dumps(summarize_payload(payload, serialized)))
+
+
+def render_job(job: BackgroundJob):
+    with st.container(border=True):
+        st.caption(job.label)
+        if job.status == 'failed':
+            st.error(f"Image generation failed. {job.error or (job.data or {}).get('sagemakerRaw', '')}")
+        elif job.done:
+            if job.data.get('cached'):
+                st.info("reuse cached result")
+            elif job.data.get('timings'):
+                st.info(f"render first image, timings {job.data['timings']}")
+            if job.data.get('params_upload'):
+                upload = job.data['params_upload']
+                st.caption(f"api_params {upload['sent_bytes']} bytes ({upload['encoding'] or 'identity'}, "
+                           f"{upload['raw_bytes']} raw) uploaded in {upload['seconds']}s")
+            for image in job.images():
+                st.image(image, use_column_width=True)
+        else:
+            st.progress(job.progress, text=job.progress_text)
+
+
+def watch_jobs(jobs, render=render_job, interval: float = 1.0):
+    """Render `jobs`, redrawn by a fragment every `interval` seconds while any is unfinished.
+
+    Fragment reruns are partial and no script thread is held between them; once all jobs
+    are done one full rerun stops the timer."""
+    if all(job.done for job in jobs):
+        render_all(jobs, render)
+        return
+
+    @st.fragment(run_every=interval)
+    def watch():
+        render_all(jobs, render)
+        if all(job.done for job in jobs):
+            st.rerun()
+
+    watch()
+
+
+def render_all(jobs, render=render_job):
+    for job in jobs:
+        render(job)
+
+
+@st.cache_resource
+def serve_metrics(port: int):
+    """Starts the metrics endpoint once per Streamlit server."""
+    return metrics.serve(port)
 
 
 def sidebar_links(action: str):
     st.set_page_config(page_title=f"{action} - ESD", layout="wide")
+    if os.getenv('METRICS_PORT'):
+        serve_metrics(int(os.getenv('METRICS_PORT')))
     st.title(f"{action}")
 
     st.sidebar.image("https://d0.awsstatic.com/logos/powered-by-aws.png", width=200)
     st.sidebar.subheader("Extension for Stable Diffusion on AWS")
-    st.sidebar.markdown(
-        """
-        - [txt2img](https://esd-txt2img.streamlit.app/)
-        - [txt2img lcm](https://esd-lcm.streamlit.app/)
-        - [img2img](https://esd-img2img.streamlit.app/)
-        - [extra-single-image](https://esd-extra-single-image.streamlit.app/)
-        - [rembg](https://esd-rembg.streamlit.app/)
-        """
-    )
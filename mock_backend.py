@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cat.png'), 'rb') as f:
+    PNG = f.read()
+
+
+class MockBackend:
+    """Local stand-in for the ESD API Gateway and its presigned S3 URLs, for benchmarks.
+
+    Serves POST inferences, PUT inferences/{id}/start, GET inferences/{id}, DELETE
+    inferences, presigned PUT of api_params, presigned GET of result/source images and a
+    blobs/{sha256} store standing in for the S3 bucket of referenced init images and masks.
+    Every request waits `latency` seconds (+/- `jitter`); API calls fail with 500 at
+    `failure_rate`; a started job stays inprogress for `run_seconds` and then ends succeed
+    (or failed at `job_failure_rate`). With `throttle_rate`, API calls beyond that many per
+    second (bursts of 10) get a 429 like API Gateway throttling. Params uploads with a
+    Content-Encoding outside `content_encodings` get a 400.
+    """
+
+    def __init__(self, port: int = 0, address: str = '127.0.0.1', latency: float = 0.0, jitter: float = 0.0,
+                 failure_rate: float = 0.0, run_seconds: float = 1.0, job_failure_rate: float = 0.0,
+                 image: bytes = PNG, content_encodings=('gzip', 'zstd'), throttle_rate: float = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.run_seconds = run_seconds
+        self.job_failure_rate = job_failure_rate
+        self.image = image
+        self.content_encodings = content_encodings
+        self.throttle_rate = throttle_rate
+        self.throttled = 0
+        self._tokens = (10.0, time.monotonic())
+        self.jobs = {}
+        self.blobs = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((address, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='mock-backend', daemon=True).start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def presigned(self, path: str):
+        signed = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        return f"{self.url}{path}?X-Amz-Date={signed}&X-Amz-Expires=3600&X-Amz-Signature=mock"
+
+    def throttle(self):
+        """True when an API call should get a 429."""
+        if not self.throttle_rate:
+            return False
+        with self._lock:
+            tokens, last = self._tokens
+            now = time.monotonic()
+            tokens = min(10.0, tokens + (now - last) * self.throttle_rate)
+            throttled = tokens < 1
+            self._tokens = (tokens if throttled else tokens - 1, now)
+            self.throttled += throttled
+        return throttled
+
+    def status(self, job):
+        if job['started'] is not None and time.monotonic() - job['started'] >= self.run_seconds:
+            job['status'] = 'failed' if job['fails'] else 'succeed'
+        return job['status']
+
+    def create(self, body):
+        inference_id = uuid.uuid4().hex
+        with self._lock:
+            self.jobs[inference_id] = {
+                'status': 'created', 'body': body, 'started': None, 'params': None,
+                'fails': random.random() < self.job_failure_rate,
+            }
+        return {'statusCode': 201, 'data': {'inference': {
+            'id': inference_id,
+            'type': body.get('task_type'),
+            'api_params_s3_location': f"s3://mock/{inference_id}/api_param.json",
+            'api_params_s3_upload_url': self.presigned(f"s3/{inference_id}/api_param.json"),
+        }}}
+
+    def start_job(self, inference_id: str):
+        job = self.jobs[inference_id]
+        job['started'] = time.monotonic()
+        if job['body'].get('inference_type') != 'Real-time':
+            job['status'] = 'inprogress'
+            return {'statusCode': 202, 'data': {'inference': {'status': 'inprogress'}}}
+
+        time.sleep(self.run_seconds)
+        return {'statusCode': 200, 'data': self.result(inference_id)}
+
+    def result(self, inference_id: str):
+        status = self.status(self.jobs[inference_id])
+        data = {'id': inference_id, 'InferenceJobId': inference_id, 'status': status}
+        if status == 'succeed':
+            data['img_presigned_urls'] = [self.presigned(f"img/{inference_id}/0.png")]
+        return data
+
+    def _handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, code: int, body=b'', content_type='application/json', head=False):
+                with backend._lock:
+                    backend.requests += 1
+                delay = backend.latency + random.uniform(-backend.jitter, backend.jitter)
+                if delay > 0:
+                    time.sleep(delay)
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def read_body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def api_failure(self):
+                if backend.throttle():
+                    self.read_body()
+                    self.send(429, {'message': 'Too Many Requests'})
+                    return True
+                if random.random() < backend.failure_rate:
+                    self.read_body()
+                    self.send(500, {'message': 'Internal server error'})
+                    return True
+                return False
+
+            def do_POST(self):
+                path = urlparse(self.path).path.strip('/').split('/')
+                if path != ['inferences']:
+                    return self.send(404, {'message': 'Not Found'})
+                if self.api_failure():
+                    return
+                self.send(200, backend.create(json.loads(self.read_body())))
+
+            def do_PUT(self):
+                path = urlparse(self.path).path.strip('/').split('/')
+                if path[0] == 'blobs' and len(path) == 2:
+                    backend.blobs[path[1]] = self.read_body()
+                    return self.send(200)
+                if path[0] == 's3' and path[1] in backend.jobs:
+                    encoding = self.headers.get('Content-Encoding')
+                    params = self.read_body()
+                    if encoding and encoding not in backend.content_encodings:
+                        return self.send(400, b'<Error><Code>InvalidArgument</Code></Error>', 'application/xml')
+                    backend.jobs[path[1]].update(params=params, encoding=encoding)
+                    return self.send(200)
+                if path[0] == 'inferences' and path[-1] == 'start' and path[1] in backend.jobs:
+                    if self.api_failure():
+                        return
+                    return self.send(200, backend.start_job(path[1]))
+                self.read_body()
+                self.send(404, {'message': 'Not Found'})
+
+            def do_DELETE(self):
+                path = urlparse(self.path).path.strip('/').split('/')
+                if path != ['inferences']:
+                    self.read_body()
+                    return self.send(404, {'message': 'Not Found'})
+                ids = json.loads(self.read_body()).get('inference_id_list') or []
+                with backend._lock:
+                    for inference_id in ids:
+                        backend.jobs.pop(inference_id, None)
+                self.send(200, {'statusCode': 204, 'message': 'deleted'})
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                path = urlparse(self.path).path.strip('/').split('/')
+                if path[0] == 'blobs' and len(path) == 2:
+                    if path[1] in backend.blobs:
+                        return self.send(200, backend.blobs[path[1]], 'application/octet-stream', head)
+                    return self.send(404, {'message': 'Not Found'}, head=head)
+                if head:
+                    return self.send(405, {'message': 'Method Not Allowed'}, head=head)
+                if path[0] in ('img', 'images'):
+                    return self.send(200, backend.image, 'image/png')
+                if path[0] == 'inferences' and len(path) == 2 and path[1] in backend.jobs:
+                    if self.api_failure():
+                        return
+                    return self.send(200, {'statusCode': 200, 'data': backend.result(path[1])})
+                self.send(404, {'message': 'Not Found'})
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock ESD API for benchmarks and offline testing")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--address", default='127.0.0.1')
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds on top of --latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of API calls answered with 500")
+    parser.add_argument("--run-seconds", type=float, default=1.0, help="time from start to succeed")
+    parser.add_argument("--job-failure-rate", type=float, default=0.0, help="fraction of jobs ending failed")
+    parser.add_argument("--throttle-rate", type=float, help="API calls per second before answering 429")
+    parser.add_argument("--content-encodings", nargs='*', default=['gzip', 'zstd'],
+                        help="params upload Content-Encodings accepted, others get a 400")
+    args = parser.parse_args()
+
+    backend = MockBackend(args.port, args.address, args.latency, args.jitter, args.failure_rate,
+                          args.run_seconds, args.job_failure_rate, content_encodings=args.content_encodings,
+                          throttle_rate=args.throttle_rate)
+    print(f"mock ESD API on {backend.url} (source images at {backend.url}images/cat.png)", flush=True)
+    backend.server.serve_forever()
@@ -0,0 +1,61 @@
+import logging
+
+import streamlit as st
+
+from lib import API_URL, API_KEY, API_USERNAME, sidebar_links, get_api, job_runner, watch_jobs, PollingStrategy, \
+    ResultCache, txt2img_inference_body, txt2img_api_params, show_payload, encode_api_params
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# results of fixed-seed requests, reused when "Reuse cached result" is ticked
+result_cache = ResultCache()
+
+# status poll backoff: start fast, back off for long running jobs
+polling = PollingStrategy(initial=1, max_interval=8)
+
+
+def create_inference_body():
+    return txt2img_inference_body(api.api_username, api.inference_type)
+
+
+def create_api_params(positive: str):
+    return txt2img_api_params(positive, seed=seed)
+
+
+def generate_image(positive_prompts: str):
+    body = create_inference_body()
+    api_params = create_api_params(positive_prompts)
+    json_string = encode_api_params(api_params)
+
+    show_payload("payload for create inference job", body)
+    show_payload("payload for api_params upload", api_params, json_string)
+
+    cache_key = result_cache.key(body, api_params) if use_result_cache else None
+    return job_runner().submit(api, body, lambda s3_url: api.upload_api_params(s3_url, json_string), polling,
+                               positive_prompts, result_cache, cache_key)
+
+
+if __name__ == "__main__":
+    try:
+        sidebar_links("txt2img")
+
+        api_url = st.text_input("API URL:", API_URL)
+        api_key = st.text_input("API KEY:", API_KEY)
+        api_username = st.text_input("API Username:", API_USERNAME)
+
+        # User input
+        prompt = st.text_input("Please input prompt:", "A cute dog")
+        seed = st.number_input("Seed (-1 for random):", value=-1, step=1)
+        use_result_cache = st.checkbox("Reuse cached result for the same seed and params", disabled=seed == -1)
+        inference_type = st.radio("Inference Type", ('Async', 'Real-time'), horizontal=True)
+        button = st.button('Generate Image')
+
+        jobs = st.session_state.setdefault('txt2img_jobs', [])
+        if button:
+            api = get_api(api_url, api_key, api_username, inference_type)
+            jobs.insert(0, generate_image(prompt))
+        watch_jobs(jobs)
+    except Exception as e:
+        logger.exception(e)
+        st.error(e)
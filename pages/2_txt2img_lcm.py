@@ -0,0 +1,51 @@
+import logging
+
+import streamlit as st
+
+from lib import API_URL, API_KEY, API_USERNAME, task_inference_body, sidebar_links, get_api, job_runner, watch_jobs, \
+    PollingStrategy, show_payload, txt2img_api_params, txt2img_lcm_template, encode_api_params
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# status poll backoff: start fast, back off for long running jobs
+polling = PollingStrategy(initial=0.25, max_interval=4)
+
+
+def create_inference_body():
+    return task_inference_body(api.api_username, api.inference_type, 'txt2img-lcm')
+
+
+def generate_image(positive_prompts: str):
+    body = create_inference_body()
+    api_params = txt2img_api_params(positive_prompts, txt2img_lcm_template)
+    json_string = encode_api_params(api_params)
+
+    show_payload("payload for create inference job", body)
+    show_payload("payload for api_params upload", api_params, json_string)
+
+    return job_runner().submit(api, body, lambda s3_url: api.upload_api_params(s3_url, json_string), polling,
+                               positive_prompts)
+
+
+if __name__ == "__main__":
+    try:
+        sidebar_links("txt2-img lcm")
+
+        api_url = st.text_input("API URL:", API_URL)
+        api_key = st.text_input("API KEY:", API_KEY)
+        api_username = st.text_input("API Username:", API_USERNAME)
+
+        # User input
+        prompt = st.text_input("What image do you want to create today?", "A cute dog <lora:lcm_lora_1_5:1>")
+        inference_type = st.radio("Inference Type", ('Async', 'Real-time'), horizontal=True)
+        button = st.button('Generate Image')
+
+        jobs = st.session_state.setdefault('txt2img_lcm_jobs', [])
+        if button:
+            api = get_api(api_url, api_key, api_username, inference_type)
+            jobs.insert(0, generate_image(prompt))
+        watch_jobs(jobs)
+    except Exception as e:
+        logger.exception(e)
+        st.error(e)
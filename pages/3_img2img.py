@@ -0,0 +1,77 @@
+import logging
+
+import streamlit as st
+
+from lib import API_URL, API_KEY, API_USERNAME, task_inference_body, sidebar_links, get_api, job_runner, watch_jobs, \
+    shared_preprocessor, shared_blob_store, PollingStrategy, ResultCache, templates, show_payload, \
+    encode_api_params
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# results of fixed-seed requests, reused when "Reuse cached result" is ticked
+result_cache = ResultCache()
+
+# status poll backoff: start fast, back off for long running jobs
+polling = PollingStrategy(initial=1, max_interval=15)
+
+
+def create_inference_body():
+    return task_inference_body(api.api_username, api.inference_type, 'img2img')
+
+
+def create_api_params(positive: str):
+    overrides = {}
+    if preprocess != 'Off':
+        # fit init_images and mask to width/height, processed once per server
+        overrides = shared_preprocessor(preprocess).img2img_overrides(templates.get('img2img_api_param.json'))
+    if reference_images:
+        # upload each unique image once, jobs carry its URL instead of the base64
+        params = dict(templates.get('img2img_api_param.json'), **overrides)
+        overrides.update(shared_blob_store().img2img_overrides(params))
+    return templates.render('img2img_api_param.json', prompt=positive, seed=seed, **overrides)
+
+
+def generate_image(positive_prompts: str):
+    body = create_inference_body()
+    api_params = create_api_params(positive_prompts)
+    json_string = encode_api_params(api_params)
+
+    show_payload("payload for create inference job", body)
+    show_payload("payload for upload", api_params, json_string)
+
+    cache_key = result_cache.key(body, api_params) if use_result_cache else None
+    return job_runner().submit(api, body, lambda s3_url: api.upload_api_params(s3_url, json_string), polling,
+                               positive_prompts, result_cache, cache_key)
+
+
+if __name__ == "__main__":
+    try:
+        sidebar_links("img2img")
+
+        # User input
+        original_image = st.image("./cat.png")
+
+        api_url = st.text_input("API URL:", API_URL)
+        api_key = st.text_input("API KEY:", API_KEY)
+        api_username = st.text_input("API Username:", API_USERNAME)
+
+        prompt = st.text_input("What image do you want to update?", "dog face")
+
+        seed = st.number_input("Seed (-1 for random):", value=-1, step=1)
+        use_result_cache = st.checkbox("Reuse cached result for the same seed and params", disabled=seed == -1)
+        inference_type = st.radio("Inference Type", ('Async', 'Real-time'), horizontal=True)
+        preprocess = st.radio("Preprocess init image and mask", ('Off', 'PNG', 'WebP'), horizontal=True)
+        reference_images = st.checkbox("Upload init image and mask once and reference them by URL "
+                                       "(needs BLOB_S3_BUCKET or BLOB_URL)", disabled=shared_blob_store() is None)
+
+        button = st.button('Generate new Image')
+
+        jobs = st.session_state.setdefault('img2img_jobs', [])
+        if button:
+            api = get_api(api_url, api_key, api_username, inference_type)
+            jobs.insert(0, generate_image(prompt))
+        watch_jobs(jobs)
+    except Exception as e:
+        logger.exception(e)
+        st.error(e)
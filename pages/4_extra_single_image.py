@@ -0,0 +1,69 @@
+import logging
+
+import streamlit as st
+
+from lib import API_URL, API_KEY, API_USERNAME, task_inference_body, sidebar_links, get_api, job_runner, watch_jobs, \
+    shared_preprocessor, PollingStrategy, templates, show_payload
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# status poll backoff: start fast, back off for long running jobs
+polling = PollingStrategy(initial=1, max_interval=15)
+
+
+def create_inference_body():
+    return task_inference_body(api.api_username, api.inference_type, 'extra-single-image')
+
+
+def generate_image(img_url: str):
+    body = create_inference_body()
+    api_params = templates.get('extra-single-image-api-params.json')
+
+    show_payload("payload for create inference job", body)
+    st.info(f"stream img from {img_url} as base64 string into api_params.image")
+    show_payload("api_params payload upload", dict(api_params))
+
+    preprocess = None
+    if image_format != 'Off':
+        preprocessor = shared_preprocessor(image_format)
+        # only a fixed target size (resize_mode 1) bounds the input size
+        size = (api_params['upscaling_resize_w'], api_params['upscaling_resize_h']) \
+            if api_params['resize_mode'] == 1 else (None, None)
+
+        def preprocess(data):
+            return preprocessor.process(data, *size)
+
+    def upload(s3_url):
+        return api.upload_api_params_with_image(s3_url, api_params, 'image', img_url, preprocess=preprocess)
+
+    return job_runner().submit(api, body, upload, polling, img_url)
+
+
+if __name__ == "__main__":
+    try:
+        sidebar_links("extra-single-image")
+
+        img_url = 'http://img.touxiangwu.com/2020/3/U3e6ny.jpg'
+        original_image = st.image(img_url)
+
+        api_url = st.text_input("API URL:", API_URL)
+        api_key = st.text_input("API KEY:", API_KEY)
+        api_username = st.text_input("API Username:", API_USERNAME)
+
+        prompt = st.text_input("Please input image URL:", img_url)
+
+        inference_type = st.radio("Inference Type", ('Async', 'Real-time'), horizontal=True)
+        image_format = st.radio("Re-encode image before upload", ('Off', 'PNG', 'WebP'), horizontal=True)
+
+        button = st.button('Generate new Image')
+
+        jobs = st.session_state.setdefault('extra_single_image_jobs', [])
+        if button:
+            api = get_api(api_url, api_key, api_username, inference_type)
+            original_image.image(api.fetch_image(prompt))
+            jobs.insert(0, generate_image(prompt))
+        watch_jobs(jobs)
+    except Exception as e:
+        logger.exception(e)
+        st.error(e)